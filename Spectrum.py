@@ -22,6 +22,8 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
+from plot_lod import LODLine
+
 class Spectrum:
 
     def __init__(
@@ -49,14 +51,20 @@ class Spectrum:
         self.num_frames = num_frames
         self.exposure = exposure
 
-        # Spectrum.data structured as a list containing each frame.
-        self.data = data
+        # Spectrum.data structured as a single array containing each frame,
+        # with shape (num_frames, xdim) (or (num_frames, ydim, xdim) for 2D
+        # frames), so that Spectrum.data[i] is a view of frame i.
+        # A list of frames is stacked once here.
+        if isinstance(data, np.ndarray):
+            self.data = data
+        else:
+            self.data = np.stack(data)
 
         # In common usage, this can be inconvenient as one may want to access
         # the data directly (without having to use Spectrum.data[0]).
         # To facilitate this we define Spectrum.int which contains only the
         # first frame of the dataset:
-        self.int = data[0]
+        self.int = self.data[0]
 
 
 
@@ -65,19 +73,68 @@ class Spectrum:
         # Plot each of the desired frames
         for frame in frames:
             plt.figure(figsize=figsize)
-            plt.plot(self.wavelength, self.data[frame])
+
+            # Decimated to the axis width (and updated on zoom/pan), see plot_lod
+            line, = plt.plot(self.wavelength, self.data[frame])
+            LODLine(line, self.wavelength, self.data[frame])
+
             plt.xlabel('Wavelength (nm)')
             plt.ylabel('Intensity (a.u.)')
             plt.title(self.filename + ', frame ' + str(frame))
             plt.show()
 
 
+    def iter_frames(self, chunk=64):
+        # Generator over the frames in blocks of (up to) chunk frames.
+        # Yields (frame_indices, block) where block has shape
+        # (len(frame_indices), xdim) (or (len(frame_indices), ydim, xdim)).
+        # For memory-mapped data (load_SPE(..., mmap=True)) only the current
+        # block is read from disk, so long acquisitions are processed in
+        # constant memory.
+
+        num_frames = len(self.data)
+
+        for start in range(0, num_frames, chunk):
+            stop = min(start + chunk, num_frames)
+            yield np.arange(start, stop), np.asarray(self.data[start:stop])
+
+
+    def mean_frame(self, chunk=64):
+        # Mean of all frames, accumulated block by block
+        return self.sum_frames(chunk=chunk) / len(self.data)
+
+
+    def max_frame(self, chunk=64):
+        # Maximum of each pixel over all frames (max-hold), block by block
+
+        result = None
+        for _, block in self.iter_frames(chunk):
+            block_max = np.amax(block, axis=0)
+            result = block_max if result is None else np.maximum(result, block_max)
+
+        return result
+
+
+    def sum_frames(self, background=None, chunk=64):
+        # Sum of all frames, accumulated block by block.
+        # If background (a single frame) is given it is subtracted from each frame.
+
+        result = 0
+        for _, block in self.iter_frames(chunk):
+            block_sum = np.sum(block, axis=0, dtype=np.float64)
+            if background is not None:
+                block_sum -= len(block) * np.asarray(background, dtype=np.float64)
+            result = result + block_sum
+
+        return result
+
+
     def to_image(self):
-        # Converts a sequence of frames with shape (xdim,) into an image (num_frames, xdim)
-        # Returns the image directly (it is not stored in the Spectrum instnace)
+        # Returns the sequence of frames with shape (xdim,) as an image
+        # (num_frames, xdim). This is a view of the data (not a copy).
 
         if self.ydim == 1:
-            return np.stack(self.data)
+            return self.data[:]
         else:
             raise ValueError('Cannot stack image data')
 
@@ -87,11 +144,27 @@ class Spectrum:
         y = np.arange(self.num_frames) * self.exposure
         x = self.wavelength
 
-        xx, yy = np.meshgrid(x, y)
-
         plt.figure(figsize=figsize)
-        p = plt.pcolormesh(xx, yy, img, **kwargs)
+        p = plt.pcolormesh(_edges(x), _edges(y), img, **kwargs)
         plt.xlabel('Wavelength (nm)')
         plt.ylabel('Time (s)')
         plt.colorbar(p)
-        plt.show()
\ No newline at end of file
+        plt.show()
+
+
+
+def _edges(centers):
+    # Cell edges (length N+1) for pcolormesh from a 1-D array of N cell centers
+
+    centers = np.asarray(centers, dtype=float)
+
+    if len(centers) == 1:
+        return np.array([centers[0] - 0.5, centers[0] + 0.5])
+
+    midpoints = (centers[1:] + centers[:-1]) / 2
+
+    return np.concatenate((
+        [centers[0] - (midpoints[0] - centers[0])],
+        midpoints,
+        [centers[-1] + (centers[-1] - midpoints[-1])]
+    ))
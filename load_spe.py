@@ -8,6 +8,8 @@
 
     A series of functions for reading Princeton instruments .SPE files
     (for version 2.xx) and storing the data in a Python-usable format.
+    The full header is available through the SPEHeader class (including the
+    XML footer of version 3.x files).
 
     The following code is largely based off of code from others, particularly:
         -> https://leonvv.me/spe-images.html
@@ -21,10 +23,14 @@
 '''
 
 
-import struct
+import os
 import numpy as np
+
+from xml.etree import ElementTree
 import matplotlib.pyplot as plt
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 
 from Spectrum import *
 
@@ -33,79 +39,378 @@ from Spectrum import *
 
 
 
-def from_bytes(b, fmt, offset):
-    # Simple helper function taken from https://leonvv.me/spe-images.html
-    # Given string of bytes b and data format fmt, reads the bytes at offset,
-    # interpreting it as the desired format.
-    size = struct.calcsize(fmt)
-    return struct.unpack(fmt, b[offset:offset+size])[0]
+# SPE header layout ==================================== #
+# The .SPE v2.x header is a fixed 4100 byte block (also present in v3.0 files,
+# which additionally have an XML footer after the data). The fields are given
+# here as (name, format, offset) following the Princeton Instruments WinView
+# file format specification, and parsed in one shot as a NumPy structured dtype.
+
+SPE_HEADER_SIZE = 4100
+
+# Wavelength/spatial calibration structure (used for the x and y axes)
+SPE_CALIBRATION_DTYPE = np.dtype({
+    'names':   ['offset', 'factor', 'current_unit', 'string', 'calib_valid',
+                'input_unit', 'polynom_unit', 'polynom_order', 'calib_count',
+                'pixel_position', 'calib_value', 'polynom_coeff', 'laser_position',
+                'new_calib_flag', 'calib_label'],
+    'formats': ['<f8', '<f8', 'u1', 'S40', 'u1',
+                'u1', 'u1', 'u1', 'u1',
+                ('<f8', (10,)), ('<f8', (10,)), ('<f8', (6,)), '<f8',
+                'u1', 'S81'],
+    'offsets': [0, 8, 16, 18, 98,
+                99, 100, 101, 102,
+                103, 183, 263, 311,
+                320, 321],
+    'itemsize': 489
+})
+
+# Region of interest structure
+SPE_ROI_DTYPE = np.dtype({
+    'names':   ['startx', 'endx', 'groupx', 'starty', 'endy', 'groupy'],
+    'formats': ['<u2'] * 6,
+    'offsets': [0, 2, 4, 6, 8, 10],
+    'itemsize': 12
+})
+
+SPE_HEADER_FIELDS = [
+    ('ControllerVersion',      '<i2',                 0),
+    ('LogicOutput',            '<i2',                 2),
+    ('AmpHiCapLowNoise',       '<u2',                 4),
+    ('xDimDet',                '<u2',                 6),
+    ('mode',                   '<i2',                 8),
+    ('exp_sec',                '<f4',                10),
+    ('VChipXdim',              '<i2',                14),
+    ('VChipYdim',              '<i2',                16),
+    ('yDimDet',                '<u2',                18),
+    ('date',                   'S10',                20),
+    ('VirtualChipFlag',        '<i2',                30),
+    ('noscan',                 '<i2',                34),
+    ('DetTemperature',         '<f4',                36),
+    ('DetType',                '<i2',                40),
+    ('xdim',                   '<u2',                42),
+    ('stdiode',                '<i2',                44),
+    ('DelayTime',              '<f4',                46),
+    ('ShutterControl',         '<u2',                50),
+    ('AbsorbLive',             '<i2',                52),
+    ('AbsorbMode',             '<u2',                54),
+    ('CanDoVirtualChipFlag',   '<i2',                56),
+    ('ThresholdMinLive',       '<i2',                58),
+    ('ThresholdMinVal',        '<f4',                60),
+    ('ThresholdMaxLive',       '<i2',                64),
+    ('ThresholdMaxVal',        '<f4',                66),
+    ('SpecAutoSpectroMode',    '<i2',                70),
+    ('SpecCenterWlNm',         '<f4',                72),
+    ('SpecGlueFlag',           '<i2',                76),
+    ('SpecGlueStartWlNm',      '<f4',                78),
+    ('SpecGlueEndWlNm',        '<f4',                82),
+    ('SpecGlueMinOvrlpNm',     '<f4',                86),
+    ('SpecGlueFinalResNm',     '<f4',                90),
+    ('PulserType',             '<i2',                94),
+    ('CustomChipFlag',         '<i2',                96),
+    ('XPrePixels',             '<i2',                98),
+    ('XPostPixels',            '<i2',               100),
+    ('YPrePixels',             '<i2',               102),
+    ('YPostPixels',            '<i2',               104),
+    ('asynen',                 '<i2',               106),
+    ('datatype',               '<i2',               108),
+    ('PulserMode',             '<i2',               110),
+    ('PulserOnChipAccums',     '<u2',               112),
+    ('PulserRepeatExp',        '<u4',               114),
+    ('PulseRepWidth',          '<f4',               118),
+    ('PulseRepDelay',          '<f4',               122),
+    ('PulseSeqStartWidth',     '<f4',               126),
+    ('PulseSeqEndWidth',       '<f4',               130),
+    ('PulseSeqStartDelay',     '<f4',               134),
+    ('PulseSeqEndDelay',       '<f4',               138),
+    ('PulseSeqIncMode',        '<i2',               142),
+    ('PImaxUsed',              '<i2',               144),
+    ('PImaxMode',              '<i2',               146),
+    ('PImaxGain',              '<i2',               148),
+    ('BackGrndApplied',        '<i2',               150),
+    ('PImax2nsBrdUsed',        '<i2',               152),
+    ('minblk',                 '<u2',               154),
+    ('numminblk',              '<u2',               156),
+    ('SpecMirrorLocation',     ('<i2', (2,)),       158),
+    ('SpecSlitLocation',       ('<i2', (4,)),       162),
+    ('CustomTimingFlag',       '<i2',               170),
+    ('ExperimentTimeLocal',    'S7',                172),
+    ('ExperimentTimeUTC',      'S7',                179),
+    ('ExposUnits',             '<i2',               186),
+    ('ADCoffset',              '<u2',               188),
+    ('ADCrate',                '<u2',               190),
+    ('ADCtype',                '<u2',               192),
+    ('ADCresolution',          '<u2',               194),
+    ('ADCbitAdjust',           '<u2',               196),
+    ('gain',                   '<u2',               198),
+    ('Comments',               ('S80', (5,)),       200),
+    ('geometric',              '<u2',               600),
+    ('xlabel',                 'S16',               602),
+    ('cleans',                 '<u2',               618),
+    ('NumSkpPerCln',           '<u2',               620),
+    ('SpecMirrorPos',          ('<i2', (2,)),       622),
+    ('SpecSlitPos',            ('<f4', (4,)),       626),
+    ('AutoCleansActive',       '<i2',               642),
+    ('UseContCleansInst',      '<i2',               644),
+    ('AbsorbStripNum',         '<i2',               646),
+    ('SpecSlitPosUnits',       '<i2',               648),
+    ('SpecGrooves',            '<f4',               650),
+    ('srccmp',                 '<i2',               654),
+    ('ydim',                   '<u2',               656),
+    ('scramble',               '<i2',               658),
+    ('ContinuousCleansFlag',   '<i2',               660),
+    ('ExternalTriggerFlag',    '<i2',               662),
+    ('lnoscan',                '<i4',               664),
+    ('lavgexp',                '<i4',               668),
+    ('ReadoutTime',            '<f4',               672),
+    ('TriggeredModeFlag',      '<i2',               676),
+    ('XMLOffset',              '<u8',               678),   # v3.0 only (spare in v2.x)
+    ('sw_version',             'S16',               688),
+    ('type',                   '<i2',               704),
+    ('flatFieldApplied',       '<i2',               706),
+    ('kin_trig_mode',          '<i2',               724),
+    ('dlabel',                 'S16',               726),
+    ('PulseFileName',          'S120',             1178),
+    ('AbsorbFileName',         'S120',             1298),
+    ('NumExpRepeats',          '<u4',              1418),
+    ('NumExpAccums',           '<u4',              1422),
+    ('YT_Flag',                '<i2',              1426),
+    ('clkspd_us',              '<f4',              1428),
+    ('HWaccumFlag',            '<i2',              1432),
+    ('StoreSync',              '<i2',              1434),
+    ('BlemishApplied',         '<i2',              1436),
+    ('CosmicApplied',          '<i2',              1438),
+    ('CosmicType',             '<i2',              1440),
+    ('CosmicThreshold',        '<f4',              1442),
+    ('NumFrames',              '<i4',              1446),
+    ('MaxIntensity',           '<f4',              1450),
+    ('MinIntensity',           '<f4',              1454),
+    ('ylabel',                 'S16',              1458),
+    ('ShutterType',            '<u2',              1474),
+    ('shutterComp',            '<f4',              1476),
+    ('readoutMode',            '<u2',              1480),
+    ('WindowSize',             '<u2',              1482),
+    ('clkspd',                 '<u2',              1484),
+    ('interface_type',         '<u2',              1486),
+    ('NumROIsInExperiment',    '<i2',              1488),
+    ('controllerNum',          '<u2',              1506),
+    ('SWmade',                 '<u2',              1508),
+    ('NumROI',                 '<i2',              1510),
+    ('ROIinfoblk',             (SPE_ROI_DTYPE, (10,)), 1512),
+    ('FlatField',              'S120',             1632),
+    ('background',             'S120',             1752),
+    ('blemish',                'S120',             1872),
+    ('file_header_ver',        '<f4',              1992),
+    ('YT_Info',                'S1000',            1996),
+    ('WinView_id',             '<i4',              2996),
+    ('xcalibration',           SPE_CALIBRATION_DTYPE, 3000),
+    ('ycalibration',           SPE_CALIBRATION_DTYPE, 3489),
+    ('Istring',                'S40',              3978),
+    ('SpecType',               'u1',               4043),
+    ('SpecModel',              'u1',               4044),
+    ('PulseBurstUsed',         'u1',               4045),
+    ('PulseBurstCount',        '<u4',              4046),
+    ('PulseBurstPeriod',       '<f8',              4050),
+    ('PulseBracketUsed',       'u1',               4058),
+    ('PulseBracketType',       'u1',               4059),
+    ('PulseTimeConstFast',     '<f8',              4060),
+    ('PulseAmplitudeFast',     '<f8',              4068),
+    ('PulseTimeConstSlow',     '<f8',              4076),
+    ('PulseAmplitudeSlow',     '<f8',              4084),
+    ('AnalogGain',             '<i2',              4092),
+    ('AvGainUsed',             '<i2',              4094),
+    ('AvGain',                 '<i2',              4096),
+    ('lastvalue',              '<i2',              4098),
+]
+
+SPE_HEADER_DTYPE = np.dtype({
+    'names':   [field[0] for field in SPE_HEADER_FIELDS],
+    'formats': [field[1] for field in SPE_HEADER_FIELDS],
+    'offsets': [field[2] for field in SPE_HEADER_FIELDS],
+    'itemsize': SPE_HEADER_SIZE
+})
+
+# Numpy type of the pixel data for each value of the datatype header field
+SPE_DATATYPES = [np.float32, np.int32, np.int16, np.uint16, None, np.float64, np.uint8, None, np.uint32]
+
+
+
+
+
+
+class SPEHeader:
+
+    '''
+    The header of a .SPE file.
+
+    All of the header fields in SPE_HEADER_FIELDS are parsed at once from the
+    4100 byte header and are available as attributes or items (e.g.
+    header.exp_sec or header['NumFrames']). Convenience properties provide the
+    values used by the Spectrum class.
+
+    For SPE v3.x files the XML footer is only read (and parsed) from the file
+    when SPEHeader.footer_xml or SPEHeader.footer is first accessed.
+    '''
+
+    def __init__(self, buffer, filename=None):
+
+        self.filename = filename
+        self.fields = np.frombuffer(buffer, dtype=SPE_HEADER_DTYPE, count=1)[0]
 
+        self._footer_xml = None
+        self._footer = None
 
 
+    def __getitem__(self, name):
 
+        value = self.fields[name]
 
+        # Return strings and scalars as plain Python types
+        # (structures such as xcalibration are returned as numpy records)
+        if isinstance(value, bytes):
+            return value.decode('utf-8', errors='replace').rstrip('\x00')
+        if isinstance(value, np.generic) and not isinstance(value, np.void):
+            return value.item()
 
-def load_SPE(filename):
-    # Opens and loads a single .SPE (v2.xx) file with name filename
-    # Returns a Spectrum object that contains the (meta)data of the
-    # corresponding file.
+        return value
 
-    # Open the file
-    try:
-        with open(filename, 'rb') as f:
-            b = f.read()
-    except:
-        with open(filename + '.SPE', 'rb') as f:
-            b = f.read()
 
-    # Get the metadata  ==================================== #
-    SPE_version = from_bytes(b, "<f", 1992)
-    num_frames = from_bytes(b, "i", 1446)
-    exposure = from_bytes(b, "<f", 10)
+    def __getattr__(self, name):
 
-    # Convert to normal string and strip extra characters
-    date_collected = b[20:30].decode('utf-8').rstrip('\x00')
-    time_collected = b[172:179].decode('utf-8').rstrip('\x00')
+        if name in SPE_HEADER_DTYPE.names:
+            return self[name]
 
-    xdim = from_bytes(b, "H", 42)  # These two are frame width/height
-    ydim = from_bytes(b, "H", 656)
+        raise AttributeError(name)
 
 
-    startx = from_bytes(b, "h", 1512)
-    calibpoly0 = from_bytes(b, "<d", 3263)
-    calibpoly1 = from_bytes(b, "<d", 3271)
-    calibpoly2 = from_bytes(b, "<d", 3279)
+    def keys(self):
+        return SPE_HEADER_DTYPE.names
+
+
+    def as_dict(self):
+        return {name: self[name] for name in self.keys()}
+
+
+    # Values used by the Spectrum class ====================== #
+    @property
+    def SPE_version(self):
+        return self.file_header_ver
+
+    @property
+    def num_frames(self):
+        return self.NumFrames
+
+    @property
+    def exposure(self):
+        return self.exp_sec
+
+    @property
+    def date_collected(self):
+        return self.date
+
+    @property
+    def time_collected(self):
+        return self.ExperimentTimeLocal
+
+    @property
+    def np_type(self):
+        return SPE_DATATYPES[self.datatype]
+
+    @property
+    def calibration_poly(self):
+        # Wavelength calibration polynomial coefficients (constant term first)
+        return self.fields['xcalibration']['polynom_coeff']
+
+    @property
+    def wavelength(self):
+        # For SPE 2.X, the wavelength is determined from a quadratic taylor expansion
+        startx = self.fields['ROIinfoblk'][0]['startx']
+        pixels = np.arange(self.xdim) + startx
+        calibpoly = self.calibration_poly
+
+        return calibpoly[0] + calibpoly[1] * pixels + calibpoly[2] * pixels**2
+
+
+    # SPE 3.x XML footer (read lazily) ======================= #
+    @property
+    def footer_xml(self):
+        # The XML footer as a string (None for files without one)
+
+        if self._footer_xml is None and self.SPE_version >= 3 and self.XMLOffset > 0:
+            with open(self.filename, 'rb') as f:
+                f.seek(self.XMLOffset)
+                self._footer_xml = f.read().decode('utf-8')
+
+        return self._footer_xml
+
+    @property
+    def footer(self):
+        # The parsed XML footer (xml.etree.ElementTree.Element)
+
+        if self._footer is None and self.footer_xml is not None:
+            self._footer = ElementTree.fromstring(self.footer_xml)
+
+        return self._footer
+
 
-    # For SPE 2.X, the wavelength is determined from a quadratic taylor expansion
-    wavelength = calibpoly0 + calibpoly1 * (np.arange(xdim)+startx) + calibpoly2 * (np.arange(xdim)+startx)**2
 
 
-    # Get the data ==================================== #
-    # Determine the size of the image data
-    datatype = from_bytes(b, "h", 108)
-    to_np_type = [np.float32, np.int32, np.int16, np.uint16, None, np.float64, np.uint8, None, np.uint32]
-    np_type = to_np_type[datatype]
-    itemsize = np.dtype(np_type).itemsize
 
-    # Pixels per image
-    count = xdim * ydim
 
-    # The parser then reads each frame consecutively from the buffer,
-    # shifting by the number of bytes per each frame = pixels * bytes_per_pixel.
+def read_SPE_header(filename):
+    # Reads only the header of a .SPE file and returns it as an SPEHeader
 
-    data = []
+    with open(filename, 'rb') as f:
+        return SPEHeader(f.read(SPE_HEADER_SIZE), filename)
 
-    for i in range(0, num_frames):
 
-        # Read out the frame from the buffer
-        frame = np.frombuffer(b, dtype=np_type, count=count, offset=4100 + i*count*itemsize)
 
-        # Convert to proper image shape if necesary
-        if ydim > 1:
-            frame = np.reshape(frame, (ydim, xdim))
 
-        # Append to list of data
-        data.append(frame)
+
+
+def load_SPE(filename, mmap=False):
+    # Opens and loads a single .SPE (v2.xx) file with name filename
+    # Returns a Spectrum object that contains the (meta)data of the
+    # corresponding file.
+    #
+    # If mmap is True, only the 4100 byte header is read and the frames are
+    # mapped from disk with np.memmap, so that frames are only paged in when
+    # they are accessed.
+
+    # Resolve the filename (allowing the .SPE extension to be omitted)
+    if not os.path.isfile(filename) and os.path.isfile(filename + '.SPE'):
+        filename = filename + '.SPE'
+
+    # Open the file
+    with open(filename, 'rb') as f:
+        if mmap:
+            b = f.read(SPE_HEADER_SIZE)
+        else:
+            b = f.read()
+
+    # Get the metadata  ==================================== #
+    header = SPEHeader(b[:SPE_HEADER_SIZE], filename)
+
+    xdim = header.xdim  # These two are frame width/height
+    ydim = header.ydim
+    num_frames = header.num_frames
+
+    wavelength = header.wavelength
+
+
+    # Get the data ==================================== #
+    # The frames are stored consecutively after the header and are read as a
+    # single contiguous array of shape (num_frames, xdim) (or
+    # (num_frames, ydim, xdim) for 2D frames), so each frame is a view into it.
+    np_type = header.np_type
+    shape = (num_frames, xdim) if ydim == 1 else (num_frames, ydim, xdim)
+
+    if mmap:
+        # Map the whole frame block at once, frames are read on access
+        data = np.memmap(filename, dtype=np_type, mode='r', offset=SPE_HEADER_SIZE, shape=shape)
+
+    else:
+        data = np.frombuffer(b, dtype=np_type, count=int(np.prod(shape)), offset=SPE_HEADER_SIZE)
+        data = data.reshape(shape)
 
 
     # Generate and return spectrum  ==================================== #
@@ -116,10 +421,10 @@ def load_SPE(filename):
         xdim = xdim,
         ydim = ydim,
         num_frames = num_frames,
-        exposure = exposure,
-        date_collected = date_collected,
-        time_collected = time_collected,
-        SPE_version = SPE_version
+        exposure = header.exposure,
+        date_collected = header.date_collected,
+        time_collected = header.time_collected,
+        SPE_version = header.SPE_version
     )
 
 
@@ -128,17 +433,51 @@ def load_SPE(filename):
 
 
 
-def load_SPEs(filenames):
+def load_SPEs(filenames, workers=None, processes=False, stream=False, **kwargs):
     # Loads multiple SPE files provided list of filenames
     # Returns the corresponding Spectra as a list of Spectrum objects
+    #
+    # If workers is given, the files are read and parsed concurrently with a
+    # pool of workers threads (or processes if processes is True). The order
+    # of the filenames is always preserved.
+    # If stream is True, a generator is returned instead of a list, yielding
+    # each Spectrum as soon as it (and all preceding files) have been loaded.
+    # Additional keyword arguments (e.g. mmap) are passed to load_SPE.
 
     if type(filenames) is not list:
         filenames = [ filenames ]
 
-    spectra = []
+    if workers is None:
+        spectra = (load_SPE(filename, **kwargs) for filename in filenames)
+
+    else:
+        spectra = _load_SPEs_pool(filenames, workers, processes, kwargs)
+
+    if stream:
+        return spectra
+
+    return list(spectra)
+
+
+
+
+def _load_SPEs_pool(filenames, workers, processes, kwargs):
+    # Starts loading the files on a pool of workers and returns a generator
+    # of the results in input order
+
+    if processes:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+
+    futures = [pool.submit(load_SPE, filename, **kwargs) for filename in filenames]
+
+    return _pool_results(pool, futures)
+
 
-    for filename in filenames:
-        spectrum = load_SPE(filename)
-        spectra.append(spectrum)
+def _pool_results(pool, futures):
+    # Yields the results of the futures in order, shutting down the pool after
 
-    return spectra
\ No newline at end of file
+    with pool:
+        for future in futures:
+            yield future.result()
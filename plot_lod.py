@@ -0,0 +1,148 @@
+'''
+    PLOT_LOD.PY
+
+    Level-of-detail decimation for plotting large spectra.
+
+    MinMaxPyramid precomputes, for bins of 2, 4, 8, ... samples, the indices
+    of the minimum and maximum of each bin. A view of the data over any x
+    range can then be served with about two points per screen pixel by
+    picking the finest level with at most one bin per pixel and plotting
+    the min and max of each bin (in order), which keeps narrow peaks visible.
+
+    LODLine ties a pyramid to a matplotlib Line2D and updates its data
+    whenever the x limits of the axes change (zoom, pan or set_xlim), so that
+    the cost of drawing is independent of the length of the spectrum.
+'''
+
+
+import numpy as np
+
+
+
+
+class MinMaxPyramid:
+
+    '''
+    Multi-resolution min/max index of the data (x, y).
+
+    Level k (k >= 1) holds the indices of the minimum and maximum of y in
+    each bin of 2**k consecutive samples (of the data sorted by x).
+    '''
+
+    def __init__(self, x, y, min_points=64):
+
+        x = np.asarray(x)
+        y = np.asarray(y)
+
+        # Decimation works on the data in order of x
+        if np.all(np.diff(x) >= 0):
+            self.x = x
+            self.y = y
+        else:
+            order = np.argsort(x, kind='stable')
+            self.x = x[order]
+            self.y = y[order]
+
+        # levels[k-1] = (imin, imax) for bins of 2**k samples
+        self.levels = []
+
+        imin = imax = np.arange(len(self.y))
+
+        while len(imin) > min_points:
+            # Pad to an even number of bins by repeating the last one
+            if len(imin) % 2:
+                imin = np.append(imin, imin[-1])
+                imax = np.append(imax, imax[-1])
+
+            left, right = imin[0::2], imin[1::2]
+            imin = np.where(self.y[right] < self.y[left], right, left)
+
+            left, right = imax[0::2], imax[1::2]
+            imax = np.where(self.y[right] > self.y[left], right, left)
+
+            self.levels.append((imin, imax))
+
+
+    def __len__(self):
+        return len(self.x)
+
+
+    def view(self, xlim, num_pixels):
+        # Returns the (x, y) to plot for the x range xlim on an axis num_pixels
+        # wide: at most about 2 * num_pixels points, the min and max of
+        # each bin at the finest sufficient level (or the raw data if it has
+        # few enough points). One point beyond each end of the range is
+        # included so that the line continues to the edges.
+
+        start = max(np.searchsorted(self.x, xlim[0], side='left') - 1, 0)
+        stop = min(np.searchsorted(self.x, xlim[1], side='right') + 1, len(self.x))
+
+        num_points = stop - start
+        num_pixels = max(int(num_pixels), 1)
+
+        # Finest level with at most one bin (two points) per pixel
+        level = 0
+        while level < len(self.levels) and num_points > (num_pixels << max(level, 1)):
+            level += 1
+
+        if level == 0:
+            return self.x[start:stop], self.y[start:stop]
+
+        imin, imax = self.levels[level - 1]
+        bins = slice(start >> level, ((stop - 1) >> level) + 1)
+
+        # The min and max of each bin, in order of x
+        first = np.minimum(imin[bins], imax[bins])
+        second = np.maximum(imin[bins], imax[bins])
+        index = np.stack([first, second], axis=1).ravel()
+
+        return self.x[index], self.y[index]
+
+
+
+
+class LODLine:
+
+    '''
+    Keeps the data of a matplotlib Line2D decimated (see MinMaxPyramid) to
+    the current x limits and pixel width of its axes.
+
+    Usage:
+        line, = ax.plot(x, y, 'k')     # Full data, for the initial autoscaling
+        LODLine(line, x, y)
+    '''
+
+    def __init__(self, line, x, y, min_points=64):
+
+        self.line = line
+        self.ax = line.axes
+        self.min_points = min_points
+        self.pyramid = MinMaxPyramid(x, y, min_points)
+
+        # Connected through closures since the callback registries only hold
+        # weak references to bound methods, so that the LODLine lives as long
+        # as its axes
+        self.callback_ids = [
+            self.ax.callbacks.connect('xlim_changed', lambda ax: self.update()),
+            self.ax.figure.canvas.mpl_connect('resize_event', lambda event: self.update())
+        ]
+
+        self.update()
+
+
+    def disconnect(self):
+        # Stop updating the line (it keeps its current data)
+        self.ax.callbacks.disconnect(self.callback_ids[0])
+        self.ax.figure.canvas.mpl_disconnect(self.callback_ids[1])
+
+
+    def update(self):
+        # Set the line data for the current view
+        x, y = self.pyramid.view(self.ax.get_xlim(), self.ax.bbox.width)
+        self.line.set_data(x, y)
+
+
+    def set_data(self, x, y):
+        # Replace the (full resolution) data of the line
+        self.pyramid = MinMaxPyramid(x, y, self.min_points)
+        self.update()
@@ -12,11 +12,16 @@ from pycftool_Backend import *
 from pycftool_Frontend import *
 from pycftool_Fit import *
 from pycftool_FitModel import *
+from pycftool_Results import *
 
 
-def open_results(filename):
+def open_results(filename, fit_class=None, fit_models=None):
 
-    return pickle.load( open( filename, "rb" ) )
+    # Results saved by older versions are pickled
+    if filename.endswith('.p'):
+        return pickle.load( open( filename, "rb" ) )
+
+    return ResultsStore(filename).load(fit_class, fit_models)
 
 
 class CFTool:
@@ -32,6 +37,7 @@ class CFTool:
                     fit_class  : Class of pycftool.Fit object which which to
                                  save results
                     metadata   : Dictionary of metadata for the dataset
+                    headless   : [OPTIONAL] run without the widget GUI
                 }
 
                 OR
@@ -42,6 +48,7 @@ class CFTool:
                                  save results
                     spectrum   : A Spectrum object from imported data
                     name       : [OPTIONAL] name for set to override filename
+                    headless   : [OPTIONAL] run without the widget GUI
                 }
 
         '''
@@ -80,7 +87,8 @@ class CFTool:
                 data_x = data_x,
                 data_y = data_y,
                 fit_class = kwargs['fit_class'],
-                metadata = spectrum.__dict__
+                metadata = spectrum.__dict__,
+                headless = kwargs.get('headless', False)
             )
 
     def close(self):
@@ -88,6 +96,9 @@ class CFTool:
             This method closes the gui
         '''
 
-        self.cftool_backend.frontend.gui.close()
+        if self.cftool_backend.frontend is not None:
+            self.cftool_backend.frontend.gui.close()
+
+        self.cftool_backend.close()
 
 
@@ -1,13 +1,369 @@
 import numpy as np
-from scipy.optimize import curve_fit
-from scipy.signal import find_peaks
+from scipy.optimize import curve_fit, least_squares
+from scipy.signal import find_peaks, peak_widths
 
+import asyncio
 import pickle
 import os
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 from pycftool_Frontend import *
 from pycftool_Fit import *
 from pycftool_FitModel import *
+from pycftool_Results import *
+
+
+# Loss functions for robust fitting (see scipy.optimize.least_squares)
+FIT_LOSSES = ['linear', 'soft_l1', 'huber', 'cauchy', 'arctan']
+
+
+def poisson_sigma(counts):
+    # Per-point standard deviations for shot noise limited counts (e.g. the
+    # raw integer data of an SPE file), sqrt(counts) with a floor of 1 count
+    return np.sqrt(np.maximum(np.asarray(counts, dtype=float), 1))
+
+
+def fit_window(fit_model, x, y, p0, sigma=None, loss='linear', outlier_threshold=None):
+    # Fits the data (x, y) in a single window with fit_model starting from the
+    # initial guess p0. Returns the fit parameters and covariance matrix.
+    # Raises an exception if the fit fails.
+    #
+    # sigma is an optional array of the standard deviation of each point
+    # (weighting the residuals by 1/sigma), and loss a robust loss function
+    # from FIT_LOSSES to reduce the influence of outliers.
+    # If outlier_threshold is given, points whose (weighted) residual is more
+    # than outlier_threshold robust standard deviations (from the median
+    # absolute deviation) are masked and the fit is redone without them.
+
+    # Robust losses are only supported by least_squares (method='trf'), while
+    # curve_fit uses leastsq (which does not accept loss) for unbounded models
+    if loss == 'linear':
+        robust = {}
+    else:
+        robust = {'method': 'trf', 'loss': loss}
+
+    fit_params, fit_covmat = curve_fit(
+
+          fit_model.evaluate,                 # Fit model function (compiled if available)
+          x,                                  # x data to fit
+          y,                                  # y data to fit
+          p0=p0,                              # Initial guess for fit params
+          sigma=sigma,                        # Uncertainty of each point (None for unweighted)
+          jac=fit_model.evaluate_jac if fit_model.has_jac else None,  # Analytic Jacobian (None to estimate)
+          bounds=(                            # Parameter bounds
+              fit_model.param_min,                # Parameter lower bound
+              fit_model.param_max                 # Parameter upper bound
+          ),
+          **robust                            # Robust loss (passed to least_squares)
+
+    )
+
+    if outlier_threshold is None:
+        return fit_params, fit_covmat
+
+    residuals = y - fit_model.evaluate(x, *fit_params)
+    if sigma is not None:
+        residuals = residuals / sigma
+
+    deviation = np.abs(residuals - np.median(residuals))
+    scale = 1.4826 * np.median(deviation)
+    keep = deviation <= outlier_threshold * scale
+
+    # Refit without the outliers (if there are any and enough points remain)
+    if scale > 0 and not np.all(keep) and np.count_nonzero(keep) > fit_model.num_params:
+        return fit_window(
+            fit_model,
+            x[keep],
+            y[keep],
+            fit_params,
+            sigma=None if sigma is None else sigma[keep],
+            loss=loss
+        )
+
+    return fit_params, fit_covmat
+
+
+
+
+def _fit_window_task(fit_model, x, y, p0, **options):
+    # Worker task for Backend.fit_windows. Runs fit_window (with the options
+    # sigma, loss and outlier_threshold) and returns the
+    # tuple (fit_params, fit_covmat, error) where error is None on success or
+    # the exception raised by the failed fit (in which case the fit parameters
+    # and covariance matrix are None).
+
+    try:
+        fit_params, fit_covmat = fit_window(fit_model, x, y, p0, **options)
+        return fit_params, fit_covmat, None
+
+    except Exception as e:
+        return None, None, e
+
+
+
+
+def data_window(x, limits, x_sorted=False):
+    # Returns an index into x selecting the points with limits[0] < x < limits[1].
+    # For sorted (strictly increasing) x the window is found by binary search
+    # and returned as a slice, so that indexing with it gives views rather
+    # than copies. Otherwise the window is an array of indices from a mask.
+
+    if x_sorted:
+        start = np.searchsorted(x, limits[0], side='right')
+        stop = np.searchsorted(x, limits[1], side='left')
+        return slice(start, max(start, stop))
+
+    # Determine the indecies for points in the window
+    # The .ravel() method flattens it to a 1-d array
+    return np.argwhere(np.logical_and(x > limits[0], x < limits[1])).ravel()
+
+
+
+
+def _frames_jacobian(fit_model, x, params, f0):
+    # Jacobian of fit_model for each set of params (shape (num_frames, num_params))
+    # evaluated on x (shape (1, len(x))). Returns shape (num_frames, len(x), num_params).
+    # Uses the analytic Jacobian if the model has one, otherwise forward differences.
+
+    if fit_model.jac is not None:
+        return fit_model.jac(x, *params.T[:, :, None])
+
+    J = np.empty(f0.shape + (params.shape[1],))
+    for k in range(params.shape[1]):
+        step = np.sqrt(np.finfo(float).eps) * np.maximum(1, np.abs(params[:, k]))
+        shifted = params.copy()
+        shifted[:, k] += step
+        J[:, :, k] = (fit_model.f(x, *shifted.T[:, :, None]) - f0) / step[:, None]
+
+    return J
+
+
+
+
+def fit_frames(spectrum, fit_model, limits, p0=None, max_iter=200, xtol=1e-8, ftol=1e-8, block=32):
+    # Fits the same peak in every frame of spectrum (a Spectrum object with
+    # 1D frames) using fit_model on the data in the window limits = (xmin, xmax).
+    #
+    # The first frame is fitted with fit_window starting from p0 (defaults to
+    # fit_model.param_default). The frames are then fitted in blocks of block
+    # frames with a vectorized Levenberg-Marquardt iteration over the stacked
+    # residuals, with one parameter vector per frame. Each block is
+    # warm-started from the last converged frame before it, with the peak
+    # position re-seeded from each frame's own data, so that drifting peaks
+    # are tracked from frame to frame.
+    #
+    # Returns the fit parameters with shape (num_frames, num_params), the
+    # covariance matrices with shape (num_frames, num_params, num_params) and
+    # a boolean mask of the frames whose fit converged.
+    #
+    # For a Lorentzian on ~700 points per frame (500 to 2000 frames) this is
+    # about 2x faster than a loop of warm-started unbounded curve_fit calls,
+    # and about 5x faster than bounded ones (as fit_window makes).
+
+    if spectrum.ydim != 1:
+        raise ValueError('Cannot fit frames of image data')
+
+    if p0 is None:
+        p0 = fit_model.param_default
+
+    # Data in the window for every frame, shape (num_frames, num_points)
+    x = np.asarray(spectrum.wavelength)
+    window = data_window(x, limits, bool(np.all(np.diff(x) > 0)))
+    fit_x = x[window]
+    Y = np.asarray(spectrum.data[:, window], dtype=float)
+
+    num_frames, num_points = Y.shape
+    num_params = fit_model.num_params
+
+    # Model evaluation broadcasts the parameters over the frames
+    X = fit_x[None, :]
+
+    params = np.empty((num_frames, num_params))
+    cost = np.empty(num_frames)
+    converged = np.zeros(num_frames, dtype=bool)
+
+    # Seed for the next block: the last converged fit. If the first frame
+    # cannot be fitted on its own the frames start from p0 (and a failure is
+    # reported through converged like for any other frame)
+    try:
+        seed = np.asarray(fit_window(fit_model, fit_x, Y[0], p0)[0], dtype=float)
+    except Exception as e:
+        print('Error encountered fitting the first frame, starting from p0:\n\t' + str(e))
+        seed = np.asarray(p0, dtype=float)
+
+    for start in range(0, num_frames, block):
+        frames = slice(start, min(start + block, num_frames))
+
+        block_p0 = np.tile(seed, (frames.stop - frames.start, 1))
+        _seed_positions(fit_model, fit_x, Y[frames], block_p0)
+
+        params[frames], cost[frames], converged[frames] = _fit_frames_block(
+            fit_model, X, Y[frames], block_p0, max_iter, xtol, ftol
+        )
+
+        block_converged = np.flatnonzero(converged[frames])
+        if len(block_converged) > 0:
+            seed = params[frames][block_converged[-1]]
+
+    # Covariance matrices as in curve_fit: inv(J^T J) scaled by the residual variance
+    J = _frames_jacobian(fit_model, X, params, fit_model.f(X, *params.T[:, :, None]))
+    JtJ = np.matmul(J.transpose(0, 2, 1), J)
+    dof = max(num_points - num_params, 1)
+    covmats = np.linalg.pinv(JtJ) * (cost / dof)[:, None, None]
+
+    return params, covmats, converged
+
+
+
+
+def _seed_positions(fit_model, x, Y, params):
+    # Sets the peak position parameter of each row of params to the extremum
+    # of the corresponding frame of Y (the maximum for positive amplitudes,
+    # the minimum for dips), in place
+
+    position_param_index = fit_model.position_param_index()
+    if position_param_index is None or len(x) == 0:
+        return
+
+    sign = 1
+    if 'a' in fit_model.param_names:
+        sign = np.sign(params[:, fit_model.param_names.index('a')])
+        sign[sign == 0] = 1
+        sign = sign[:, None]
+
+    peak = np.argmax(sign * (Y - np.median(Y, axis=1, keepdims=True)), axis=1)
+    params[:, position_param_index] = x[peak]
+
+
+
+
+def _fit_frames_block(fit_model, X, Y, params, max_iter, xtol, ftol):
+    # Vectorized Levenberg-Marquardt iteration for the frames Y (one row per
+    # frame) starting from params (one row per frame). Returns the fit
+    # parameters, the cost (sum of squared residuals) and a mask of the
+    # frames which converged (stopped on xtol or ftol with finite parameters)
+
+    num_frames, num_params = params.shape
+
+    lower = np.asarray(fit_model.param_min, dtype=float)
+    upper = np.asarray(fit_model.param_max, dtype=float)
+
+    model = lambda params: fit_model.f(X, *params.T[:, :, None])
+
+    params = np.clip(params, lower, upper)
+    residuals = Y - model(params)
+    cost = np.sum(residuals**2, axis=1)
+    damping = np.full(num_frames, 1e-3)
+    diag = np.arange(num_params)
+
+    # Frames still being iterated, and those which converged
+    active = np.ones(num_frames, dtype=bool)
+    converged = np.zeros(num_frames, dtype=bool)
+
+    for iteration in range(max_iter):
+
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+
+        J = _frames_jacobian(fit_model, X, params[idx], Y[idx] - residuals[idx])
+        JtJ = np.matmul(J.transpose(0, 2, 1), J)
+        grad = np.matmul(J.transpose(0, 2, 1), residuals[idx][..., None])[..., 0]
+
+        # Damped normal equations (Marquardt scaling by the diagonal of J^T J)
+        A = JtJ.copy()
+        A[:, diag, diag] += damping[idx, None] * JtJ[:, diag, diag]
+        try:
+            step = np.linalg.solve(A, grad[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.einsum('npq,nq->np', np.linalg.pinv(A), grad)
+
+        trial = np.clip(params[idx] + step, lower, upper)
+        trial_residuals = Y[idx] - model(trial)
+        trial_cost = np.sum(trial_residuals**2, axis=1)
+
+        # Accept the steps which decrease the cost, adjust the damping
+        improved = trial_cost < cost[idx]
+        small_decrease = improved & (cost[idx] - trial_cost <= ftol * trial_cost)
+        accepted = idx[improved]
+        params[accepted] = trial[improved]
+        residuals[accepted] = trial_residuals[improved]
+        cost[accepted] = trial_cost[improved]
+        damping[idx] = np.where(improved, damping[idx] / 10, damping[idx] * 10)
+
+        # Stop iterating frames whose steps or cost decrease became negligible
+        # (converged) or whose damping blew up (failed)
+        small_step = np.all(np.abs(step) <= xtol * (np.abs(params[idx]) + xtol), axis=1)
+        done = small_step | small_decrease
+        converged[idx[done]] = True
+        active[idx[done | (damping[idx] > 1e16)]] = False
+
+    converged &= np.all(np.isfinite(params), axis=1) & np.isfinite(cost)
+
+    return params, cost, converged
+
+
+
+
+class FitCache():
+
+    '''
+    Least-recently-used cache of fit results (fit_params, fit_covmat, error),
+    see _fit_window_task. Failed fits are cached as well.
+
+    Keys are built by Backend.fit_cache_key from the data, the window index
+    range, the fit model name, the (rounded) initial guess and the parameter
+    bounds. At most maxsize results are kept; hits and misses are counted.
+    '''
+
+    def __init__(self, maxsize=256):
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self.results = OrderedDict()
+
+
+    def __len__(self):
+        return len(self.results)
+
+
+    def get(self, key):
+        # Returns the cached result for key (None if not cached)
+
+        if key is None or key not in self.results:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.results.move_to_end(key)
+
+        return self.results[key]
+
+
+    def put(self, key, result):
+
+        if key is None or self.maxsize <= 0:
+            return
+
+        self.results[key] = result
+        self.results.move_to_end(key)
+
+        # Drop the least recently used results
+        while len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+
+
+    def clear(self):
+
+        self.results.clear()
+        self.hits = 0
+        self.misses = 0
+
+
 
 
 class Backend():
@@ -19,21 +375,48 @@ class Backend():
                  fit_class,        # Class of fit result
                  metadata = {      # Dictionary of data metadata
                                 'name': 'unnamed_data'     # Must at least contain a name key
-                            }
+                            },
+                 headless = False, # Run without generating the widget frontend
+                 fit_cache_size = 256, # Number of fit results kept in the fit cache
+                 sigma = None      # Standard deviation of each data_y point, or 'poisson'
                 ):
 
         self.fit_models = fit_models
         self.model_names = [model.name for model in self.fit_models]
 
-        self.x = data_x
-        self.y = data_y
+        self.x = np.asarray(data_x)
+        self.y = np.asarray(data_y)
         self.meta = metadata
 
+        # Wavelength axes are normally monotonic, in which case data windows
+        # are found by binary search and served as views (see data_window)
+        self.x_sorted = bool(np.all(np.diff(self.x) > 0))
+
         self.fit_class = fit_class
 
-        self.fits = []  # Set of fits generated by the backend
+        # Weighting of the fits: per-point standard deviations of the data
+        # (None for unweighted fits). 'poisson' uses sqrt(counts), appropriate
+        # for raw CCD counts (see poisson_sigma)
+        if isinstance(sigma, str) and sigma == 'poisson':
+            sigma = poisson_sigma(self.y)
+        self.sigma = None if sigma is None else np.asarray(sigma, dtype=float)
+
+        # Robust loss function (one of FIT_LOSSES) and threshold (in robust
+        # standard deviations) for masking outliers and refitting (None to keep
+        # all points), see fit_window
+        self.fit_losses = FIT_LOSSES
+        self.fit_loss = 'linear'
+        self.outlier_threshold = None
+
+        # Set of fits generated by the backend
+        self.fits = FitCollection(self.x, self.y, fit_class, self.meta, self.fit_models)
 
-        # Data to fit
+        # Number of fits already written to the results file by save
+        # (None if the file needs to be (re)written from scratch)
+        self.num_saved_fits = None
+
+        # Data to fit and its index (window) in the data
+        self.fit_window = None
         self.fit_x = None
         self.fit_y = None
 
@@ -50,6 +433,26 @@ class Backend():
         # y data for the most recent fit result
         self.fit_result = None
 
+        # Cache of fit results, so that refitting a window with identical
+        # inputs (e.g. when revisiting peaks in auto mode) is instant
+        self.fit_cache = FitCache(fit_cache_size)
+
+        # Fits requested from the widgets run in the background on
+        # fit_executor (a single thread by default, created on first use, any
+        # concurrent.futures executor can be set instead), see request_fit.
+        # Each request (or change of the fit window) increments fit_generation
+        # and results of superseded requests are discarded.
+        self.fit_executor = None
+        self.fit_future = None
+        self.fit_generation = 0
+
+        # If enabled (off by default, edits only update the initial guess and
+        # its live preview), parameter edits trigger a refit of a window which
+        # has already been fitted, fit_debounce seconds after the last edit
+        self.refit_on_edit = False
+        self.fit_debounce = 0.3
+        self.debounce_handle = None
+
 
         # Auto fitting mode peaks
         self.peak_idxs = []
@@ -61,20 +464,62 @@ class Backend():
 
         self.autofit_window_width = 1
 
-        # Lastly generate the frontend
-        self.frontend = Frontend(self)
+        # Fit (e.g. the last accepted fit) or FitCollection (e.g. the fits of
+        # the same peaks in a previous spectrum) used to warm-start the
+        # initial guesses in auto mode (see guess_params). Set to the last
+        # accepted fit when accepting a fit in auto mode.
+        self.warm_start = None
+
+        # Lastly generate the frontend (unless running headless, e.g. for
+        # batch fitting on a server with autofit_all)
+        if headless:
+            self.frontend = None
+        else:
+            self.frontend = Frontend(self)
+
+
 
 
 
+    def get_window(self, limits):
+
+        # Index (slice for sorted data) of the points within limits
+        return data_window(self.x, limits, self.x_sorted)
 
 
     def get_data_in_range(self, limits):
 
-        # Determine the indecies for points in the figure viewport
-        # The .ravel() method flattens it to a 1-d array
-        mask = np.argwhere(np.logical_and(self.x > limits[0], self.x < limits[1])).ravel()
+        # Determine the points in the figure viewport
+        window = self.get_window(limits)
+
+        return self.x[window], self.y[window]
 
-        return self.x[mask], self.y[mask]
+
+    def set_fit_range(self, limits):
+
+        # Set the data to fit to the points within limits
+        self.fit_window = self.get_window(limits)
+        self.fit_x = self.x[self.fit_window]
+        self.fit_y = self.y[self.fit_window]
+
+        # Fits of the previous window no longer apply
+        self.cancel_fit()
+        self.fit_params = None
+        self.fit_covmat = None
+
+
+    def new_fit(self, window, fit_model, fit_params, fit_covmat):
+
+        # Create a Fit object referencing the data in window
+        return self.fit_class(
+            data_x = self.x,
+            data_y = self.y,
+            window = window,
+            fit_model = fit_model,
+            fit_params = fit_params,
+            fit_covmat = fit_covmat,
+            meta = self.meta
+        )
 
 
 
@@ -87,9 +532,68 @@ class Backend():
         # Update the parameter
         self.param_vect[index] = change.new
 
+        # Refine the current fit with the edited parameters
+        if self.refit_on_edit and self.fit_params is not None:
+            self.schedule_fit()
+
+
 
 
 
+    def fit_cache_key(self, fit_model, window, p0):
+
+        # Key identifying a fit in the fit cache (None if it cannot be cached)
+        if window is None:
+            return None
+
+        if isinstance(window, slice):
+            window_key = (window.start, window.stop)
+        else:
+            window_key = np.asarray(window).tobytes()
+
+        return (
+            id(self.x),
+            id(self.y),
+            id(self.sigma),
+            window_key,
+            fit_model.name,
+            tuple(float('%.10g' % p) for p in p0),   # Rounded initial guess
+            tuple(fit_model.param_min),
+            tuple(fit_model.param_max),
+            self.fit_loss,
+            self.outlier_threshold
+        )
+
+
+    def fit_options(self, window):
+
+        # Keyword arguments of fit_window for the data in window (weights,
+        # loss and outlier masking)
+        return {
+            'sigma'             : None if self.sigma is None else self.sigma[window],
+            'loss'              : self.fit_loss,
+            'outlier_threshold' : self.outlier_threshold
+        }
+
+
+    def cached_fit_window(self, fit_model, window, p0):
+
+        # Fit the data in window (an index from get_window), using the fit
+        # cache. Raises an exception if the fit fails.
+        key = self.fit_cache_key(fit_model, window, p0)
+        result = self.fit_cache.get(key)
+
+        if result is None:
+            result = _fit_window_task(fit_model, self.x[window], self.y[window], p0,
+                                      **self.fit_options(window))
+            self.fit_cache.put(key, result)
+
+        fit_params, fit_covmat, error = result
+        if error is not None:
+            raise error
+
+        return fit_params, fit_covmat
+
 
     def fit_data(self, change):
 
@@ -98,56 +602,171 @@ class Backend():
             # Attempt a curve fit
             # This method can often fail if the fit model or initial parameters
             # are very far off. As such it is necessary to enclose in a try statement
-            self.fit_params, self.fit_covmat = curve_fit(
+            fit_params, fit_covmat = self.cached_fit_window(
+                self.cur_fitmodel,
+                self.fit_window,
+                self.param_vect
+            )
 
-                  self.cur_fitmodel.f,                # Fit model function (callable)
-                  self.fit_x,                         # x data to fit
-                  self.fit_y,                         # y data to fit
-                  p0=self.param_vect,                 # Initial guess for fit params
-                  bounds=(                            # Parameter bounds
-                      self.cur_fitmodel.param_min,        # Parameter lower bound
-                      self.cur_fitmodel.param_max         # Parameter upper bound
-                  )
+            self.apply_fit(fit_params, fit_covmat)
+
+        except Exception as e:
+
+            print('Error encountered with fit:\n\t' + str(e))
 
-            )
 
+    def apply_fit(self, fit_params, fit_covmat):
 
-            # Compute the updated fit line
-            self.fit_result = self.cur_fitmodel.f(self.fit_x, *self.fit_params)
+        self.fit_params = fit_params
+        self.fit_covmat = fit_covmat
 
-            # Update the front end
+        # Compute the updated fit line
+        self.fit_result = self.cur_fitmodel.f(self.fit_x, *self.fit_params)
+
+        # Update the front end
+        if self.frontend is not None:
             self.frontend.update_results()
 
-        except Exception as e:
 
-            print('Error encountered with fit:\n\t' + str(e))
+    def request_fit(self, change=None):
+
+        # Fits the current window like fit_data, but in the background on
+        # fit_executor, so that the widget callbacks return immediately. The
+        # result is applied on the event loop when it lands, unless a newer
+        # request (or a change of the fit window) has superseded it.
+        # Without a running asyncio event loop (outside of Jupyter) the fit
+        # is run synchronously with fit_data.
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return self.fit_data(change)
+
+        self.cancel_fit()
+        generation = self.fit_generation
+
+        key = self.fit_cache_key(self.cur_fitmodel, self.fit_window, self.param_vect)
+        result = self.fit_cache.get(key)
+        if result is not None:
+            return self.__fit_done(generation, result)
+
+        if self.fit_executor is None:
+            self.fit_executor = ThreadPoolExecutor(max_workers=1)
+
+        self.fit_future = self.fit_executor.submit(
+            _fit_window_task,
+            self.cur_fitmodel,
+            self.fit_x,
+            self.fit_y,
+            list(self.param_vect),
+            **self.fit_options(self.fit_window)
+        )
+
+        def done(future):
+            # Called on the executor thread: hand the result over to the loop
+            if not future.cancelled():
+                loop.call_soon_threadsafe(self.__fit_landed, generation, key, future)
+
+        self.fit_future.add_done_callback(done)
+
+
+    def __fit_landed(self, generation, key, future):
+
+        result = future.result()
+
+        # Results are cached even if superseded, in case they are requested again
+        self.fit_cache.put(key, result)
+
+        if future is self.fit_future:
+            self.fit_future = None
+
+        self.__fit_done(generation, result)
+
+
+    def __fit_done(self, generation, result):
+
+        # Discard results of superseded requests
+        if generation != self.fit_generation:
+            return
+
+        fit_params, fit_covmat, error = result
+        if error is not None:
+            print('Error encountered with fit:\n\t' + str(error))
+            return
+
+        self.apply_fit(fit_params, fit_covmat)
+
+
+    def schedule_fit(self, change=None):
+
+        # Debounced request_fit, run fit_debounce seconds after the last call
+        self.cancel_debounce()
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return self.request_fit(change)
+
+        self.debounce_handle = loop.call_later(self.fit_debounce, self.request_fit)
+
+
+    def cancel_debounce(self):
+
+        if self.debounce_handle is not None:
+            self.debounce_handle.cancel()
+            self.debounce_handle = None
+
+
+    def cancel_fit(self):
+
+        # Supersede any requested fit: pending debounced requests and queued
+        # fits are cancelled, and the result of a running fit is discarded
+        self.cancel_debounce()
+        self.fit_generation += 1
+
+        if self.fit_future is not None:
+            self.fit_future.cancel()
+            self.fit_future = None
+
+
+    def close(self):
+
+        # Stop the background fitting
+        self.cancel_fit()
+        if self.fit_executor is not None:
+            self.fit_executor.shutdown(wait=False)
+            self.fit_executor = None
 
 
     def save(self, change):
 
         try:
-            name = 'fit_results_' + str(self.meta['name'] ) + '.p'
+            name = 'fit_results_' + str(self.meta['name'] ) + '.npz'
         except Exception:
-            name = 'fit_results_' + str(self.meta['filename'] ) + '.p'
+            name = 'fit_results_' + str(self.meta['filename'] ) + '.npz'
         except:
-            name = 'fit_results.p'
-
-        # Create a dictionary to hold the relevant metadata and results (Fit objects)
-        results = {
-            'data_x' : self.x,
-            'data_y' : self.y,
-            'meta'   : self.meta,
-            'fits'   : self.fits
-        }
+            name = 'fit_results.npz'
 
+        # The data is stored once with the fits as columns (see ResultsStore).
+        # Fits added since the last save are appended without rewriting the file.
+        store = ResultsStore(name)
+
+        if self.num_saved_fits is not None and os.path.isfile(name):
+            store.append(self.fits[self.num_saved_fits:])
+        else:
+            store.write(self.x, self.y, self.meta, self.fits)
 
+        self.num_saved_fits = len(self.fits)
 
-        pickle.dump( results, open(name, 'wb') )
         print('Saved results!')
 
     def delete_fit(self, index):
 
-        fit_to_delete = self.fits.pop(index)
+        fit_to_delete = self.fits.delete(index)
+
+        # Deleting a fit that was already saved requires rewriting the file
+        if self.num_saved_fits is not None and index < self.num_saved_fits:
+            self.num_saved_fits = None
 
         # Would be good to delete the fit from memory... To do later...
 
@@ -165,4 +784,294 @@ class Backend():
         if len(self.peak_idxs) > 0:
             return True
         else:
-            return False
\ No newline at end of file
+            return False
+
+
+
+    def fit_windows(self, windows, fit_model, p0s=None, executor=None, workers=None):
+        # Fits fit_model in each window of a list of windows [(xmin, xmax), ...]
+        # in parallel.
+        #
+        # p0s is an optional list with an initial guess for each window
+        # (defaults to fit_model.param_default for every window).
+        # The fits are run on executor if given (any concurrent.futures
+        # executor, left running), otherwise on a new ProcessPoolExecutor with
+        # workers processes. workers=1 runs the fits serially in this process.
+        #
+        # Returns a list of (fit_params, fit_covmat, error) tuples in the same
+        # order as windows. error is None for successful fits and the raised
+        # exception for failed fits.
+
+        if p0s is None:
+            p0s = [list(fit_model.param_default)] * len(windows)
+
+        results = [None] * len(windows)
+        keys = [None] * len(windows)
+
+        # Only the data in each window (not already in the fit cache) is sent
+        # to the workers, with the fit options (see fit_options)
+        tasks = {}
+        options = {}
+        for i, (limits, p0) in enumerate(zip(windows, p0s)):
+            window = self.get_window(limits)
+            keys[i] = self.fit_cache_key(fit_model, window, p0)
+
+            results[i] = self.fit_cache.get(keys[i])
+            if results[i] is None:
+                tasks[i] = (fit_model, self.x[window], self.y[window], p0)
+                options[i] = self.fit_options(window)
+
+        if executor is None and workers == 1:
+            for i, task in tasks.items():
+                results[i] = _fit_window_task(*task, **options[i])
+
+        elif executor is None:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {i: pool.submit(_fit_window_task, *task, **options[i]) for i, task in tasks.items()}
+                for i, future in futures.items():
+                    results[i] = future.result()
+
+        else:
+            futures = {i: executor.submit(_fit_window_task, *task, **options[i]) for i, task in tasks.items()}
+            for i, future in futures.items():
+                results[i] = future.result()
+
+        for i in tasks:
+            self.fit_cache.put(keys[i], results[i])
+
+        return results
+
+
+
+
+    def guess_params(self, fit_model, peak_idx, window, previous=None):
+
+        # Estimate the initial guess of fit_model for the peak at peak_idx
+        # fitted with the data in window (an index from get_window):
+        #   mu    : the peak position
+        #   gamma : the peak FWHM (from scipy.signal.peak_widths)
+        #   p0/p1 : the background at the peak and its slope from the window edges
+        #   a     : the peak height above the background
+        # Parameters the estimates do not apply to keep their default values.
+        #
+        # previous is an optional Fit or FitCollection to warm-start from. For a
+        # FitCollection the fit of the same model closest to the peak (within the
+        # window) is used. The guess then starts from the previous fit
+        # parameters, with only the peak position, amplitude and background
+        # offset replaced by the estimates from the data.
+
+        fit_x = self.x[window]
+        fit_y = self.y[window]
+
+        p0 = list(fit_model.param_default)
+        mu = self.x[peak_idx]
+
+        position_param_index = fit_model.position_param_index()
+        if position_param_index is not None:
+            p0[position_param_index] = mu
+
+        if len(fit_x) == 0:
+            return p0
+
+        # Background from the mean of the data at each edge of the window
+        num_edge = max(1, len(fit_x) // 10)
+        x_left, y_left = np.mean(fit_x[:num_edge]), np.mean(fit_y[:num_edge])
+        x_right, y_right = np.mean(fit_x[-num_edge:]), np.mean(fit_y[-num_edge:])
+
+        if x_right != x_left:
+            slope = (y_right - y_left) / (x_right - x_left)
+        else:
+            slope = 0
+
+        background = y_left + slope * (mu - x_left)
+
+        # Peak width, searched only within a window's length of the peak (so
+        # that the cost does not grow with the length of the spectrum), then
+        # converted from fractional indices to x between the neighbouring points
+        start = max(peak_idx - len(fit_x), 0)
+        stop = min(peak_idx + len(fit_x) + 1, len(self.y))
+        _, _, left_ips, right_ips = peak_widths(self.y[start:stop], [peak_idx - start], rel_height=0.5)
+        gamma = np.abs(self.__index_to_x(start + right_ips[0]) - self.__index_to_x(start + left_ips[0]))
+
+        estimates = {
+            'a'     : self.y[peak_idx] - background,
+            'gamma' : gamma,
+            'p0'    : background,
+            'p1'    : slope
+        }
+
+        # Warm start from a previous fit of the same model
+        previous_fit = None
+
+        if isinstance(previous, FitCollection):
+            if position_param_index is not None:
+                positions = previous.param(fit_model.param_names[position_param_index])
+
+                # Only consider fits of the same model
+                same_model_ids = [model_id for model_id, model in enumerate(previous.fit_models)
+                                  if model.name == fit_model.name]
+                positions[~np.isin(previous.model_id, same_model_ids)] = np.nan
+
+                distance = np.abs(positions - mu)
+                if np.any(distance <= np.ptp(fit_x) / 2):
+                    previous_fit = previous[int(np.nanargmin(distance))]
+
+        elif previous is not None:
+            previous_fit = previous
+
+        if previous_fit is not None and previous_fit.fit_model.name == fit_model.name:
+            p0 = list(previous_fit.fit_params)
+            estimates = {name: estimates[name] for name in ['a', 'p0']}
+
+        for name, value in estimates.items():
+            if name in fit_model.param_names and np.isfinite(value):
+                p0[fit_model.param_names.index(name)] = value
+
+        if position_param_index is not None:
+            p0[position_param_index] = mu
+
+        # Keep the guess within the parameter bounds (gamma must be positive)
+        p0 = np.clip(p0, fit_model.param_min, fit_model.param_max)
+        if 'gamma' in fit_model.param_names:
+            gamma_index = fit_model.param_names.index('gamma')
+            if p0[gamma_index] <= 0:
+                p0[gamma_index] = fit_model.param_default[gamma_index]
+
+        return list(p0)
+
+
+    def __index_to_x(self, index):
+        # x at a fractional index, interpolated between its neighbouring points
+        i = min(int(np.floor(index)), len(self.x) - 1)
+        j = min(i + 1, len(self.x) - 1)
+        return self.x[i] + (index - i) * (self.x[j] - self.x[i])
+
+
+
+
+    def fit_global(self, fit_model, limits, p0=None, band=10):
+
+        # Fits all of the peaks in the window limits = (xmin, xmax) at once with
+        # a composite model (e.g. Lorentzian_multi) using least_squares with a
+        # sparse Jacobian, where each peak only influences the samples within
+        # band FWHMs of its initial position (see FitModel.jac_sparsity).
+        #
+        # If p0 is None the peaks found in the window by find_peaks (up to
+        # fit_model.num_peaks of the most prominent) are used to build the
+        # initial guess with guess_params.
+        #
+        # Returns the fit parameters and covariance matrix (as fit_window).
+        # Raises an exception if the fit fails.
+
+        window = self.get_window(limits)
+        fit_x = self.x[window]
+        fit_y = self.y[window]
+
+        if p0 is None:
+            p0 = self.guess_global_params(fit_model, window)
+
+        sparsity = fit_model.jac_sparsity(fit_x, p0, band)
+
+        result = least_squares(
+            lambda params: fit_model.f(fit_x, *params) - fit_y,
+            p0,
+            jac=lambda params: fit_model.jac_sparse(fit_x, params, sparsity),
+            bounds=(fit_model.param_min, fit_model.param_max),
+            x_scale='jac',
+            tr_solver='lsmr'
+        )
+
+        if not result.success:
+            raise RuntimeError('Global fit failed: ' + result.message)
+
+        # Covariance matrix as in curve_fit: inv(J^T J) scaled by the residual variance
+        JtJ = (result.jac.T @ result.jac).toarray()
+        dof = max(len(fit_x) - len(p0), 1)
+        fit_covmat = np.linalg.pinv(JtJ) * (2 * result.cost / dof)
+
+        return result.x, fit_covmat
+
+
+    def guess_global_params(self, fit_model, window):
+
+        # Initial guess for a composite model (e.g. Lorentzian_multi) from the
+        # most prominent peaks found in window, estimated as for single peaks
+        # with guess_params
+
+        peak_idxs, properties = find_peaks(self.y[window], **self.peak_search_params_dict)
+        indices = np.arange(len(self.y))[window]
+
+        # Keep the most prominent (or, without a prominence search, the
+        # highest) peaks, in order of position
+        if 'prominences' in properties:
+            ranking = properties['prominences']
+        else:
+            ranking = self.y[window][peak_idxs]
+        order = np.argsort(ranking)[::-1]
+        peak_idxs = np.sort(peak_idxs[order[:fit_model.num_peaks]])
+
+        if len(peak_idxs) < fit_model.num_peaks:
+            raise ValueError('Found ' + str(len(peak_idxs)) + ' peaks for a model with '
+                             + str(fit_model.num_peaks))
+
+        single_model = Lorentzian_p1()
+        p0 = []
+        for peak_idx in peak_idxs:
+            a, mu, gamma, background, slope = self.guess_params(single_model, indices[peak_idx], window)
+            p0 += [a, mu, gamma]
+
+        # Linear background about x_ref (from the last peak's estimate)
+        poly = [0] * (fit_model.poly_order + 1)
+        poly[0] = background + slope * (fit_model.x_ref - mu)
+        if fit_model.poly_order > 0:
+            poly[1] = slope
+
+        return p0 + poly
+
+
+
+
+    def autofit_all(self, fit_model, window_width, accept=None, workers=1):
+        # Runs the auto fit procedure without any GUI interaction.
+        #
+        # Searches for peaks with peak_search_params_dict, fits fit_model in a
+        # window of width window_width centered on each peak (starting from
+        # guess_params, warm-started from self.warm_start) and stores the
+        # resulting Fit objects.
+        # accept is an optional callable taking a Fit object and returning
+        # True if the fit should be kept; by default all successful fits are kept.
+        # workers sets the number of processes used for fitting (see fit_windows).
+        # Returns the list of accepted fits (these are also added to self.fits).
+
+        accepted_fits = []
+
+        if not self.find_peaks():
+            return accepted_fits
+
+        self.autofit_window_width = window_width
+
+        # Window and initial guess (see guess_params) for each peak
+        windows = []
+        p0s = []
+        for peak_idx in self.peak_idxs:
+            limits = (self.x[peak_idx] - window_width/2, self.x[peak_idx] + window_width/2)
+            windows.append(limits)
+            p0s.append(
+                self.guess_params(fit_model, peak_idx, self.get_window(limits), self.warm_start)
+            )
+
+        results = self.fit_windows(windows, fit_model, p0s=p0s, workers=workers)
+
+        for limits, (fit_params, fit_covmat, error) in zip(windows, results):
+
+            # Failed fits are rejected
+            if error is not None:
+                continue
+
+            fit = self.new_fit(self.get_window(limits), fit_model, fit_params, fit_covmat)
+
+            if accept is None or accept(fit):
+                self.fits.append(fit)
+                accepted_fits.append(fit)
+
+        return accepted_fits
@@ -0,0 +1,436 @@
+'''
+    PYCFTOOL_EXPRESSION.PY
+
+    Fit models defined by an expression string, e.g.
+
+        ExpressionModel('a*(g**2/4)/((x-mu)**2+g**2/4) + p0 + p1*(x-mu)',
+                        defaults={'a': 1, 'g': 1},
+                        bounds={'mu': (0, np.inf), 'g': (0, np.inf)})
+
+    (also available as FitModel.from_expression). The expression is parsed
+    once with the ast module. Every name other than x, the supported functions
+    (exp, log, sqrt, sin, cos, tan, arctan, sinh, cosh, tanh, abs, sign) and
+    the constants pi and e is a parameter, in order of first appearance. The
+    analytic Jacobian is derived symbolically from the parsed expression and
+    both are generated as vectorized NumPy source code. If numba is installed,
+    loop kernels generated from the same expressions are compiled and
+    registered for the model (see register_kernel in pycftool_FitModel).
+
+    The derivatives are cached on disk (in EXPRESSION_CACHE_DIR) by the hash
+    of the normalized expression, so that a model is only differentiated the
+    first time it is used. Cached derivatives are validated like the
+    expression itself before any code is generated from them.
+'''
+
+
+import ast
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from pycftool_FitModel import FitModel, register_kernel
+
+
+# Directory of the generated source cache
+EXPRESSION_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pycftool')
+
+# Bumped whenever the generated code changes, to invalidate the cache
+_CACHE_VERSION = 2
+
+# Supported functions (evaluated with NumPy) and constants
+_FUNCTIONS = ['exp', 'log', 'sqrt', 'sin', 'cos', 'tan', 'arctan',
+              'sinh', 'cosh', 'tanh', 'abs', 'sign']
+_CONSTANTS = {'pi': np.pi, 'e': np.e}
+
+_NAMESPACE = dict({name: getattr(np, name) for name in _FUNCTIONS}, **_CONSTANTS)
+
+
+
+
+class ExpressionModel(FitModel):
+
+    '''
+    Fit model with the function and analytic Jacobian generated from an
+    expression in x and the parameters.
+
+    defaults and bounds are dictionaries of parameter name -> default value
+    (1 if not given) and parameter name -> (min, max) (unbounded if not given).
+    The name defaults to the expression itself.
+    '''
+
+    def __init__(self,
+                 expression,
+                 defaults = None,
+                 bounds = None,
+                 name = None,
+                 param_dict = None,
+                 cache_dir = None
+                ):
+
+        self.expression = expression
+        self.defaults = dict(defaults or {})
+        self.bounds = dict(bounds or {})
+        self.cache_dir = cache_dir
+
+        code = _generate(expression, EXPRESSION_CACHE_DIR if cache_dir is None else cache_dir)
+        param_names = code['param_names']
+
+        for param_name in list(self.defaults) + list(self.bounds):
+            if param_name not in param_names:
+                raise ValueError('Unknown parameter ' + param_name + ' in ' + expression)
+
+        super().__init__(
+            name = expression if name is None else name,
+            param_names = param_names,
+            param_default = [self.defaults.get(p, 1) for p in param_names],
+            param_min = [self.bounds.get(p, (-np.inf, np.inf))[0] for p in param_names],
+            param_max = [self.bounds.get(p, (-np.inf, np.inf))[1] for p in param_names],
+            param_dict = param_dict
+        )
+
+        self.__compile(code)
+
+
+    def __compile(self, code):
+        namespace = dict(_NAMESPACE)
+        exec(code['source'], namespace)
+
+        self.__f = namespace['f']
+        self.__jac = namespace['jac']
+
+        # Generated functions have no source file for numba to cache against
+        register_kernel(self, namespace['f_kernel'], namespace['f_jac_kernel'], namespace['jac_kernel'],
+                        cache=False)
+
+
+    def f(self, x, *params):
+        return self.__f(x, *params)
+
+    def jac(self, x, *params):
+        # Stacked on the last axis so that the Jacobian also broadcasts over
+        # arrays of parameters
+        return np.stack(np.broadcast_arrays(x, *self.__jac(x, *params))[1:], axis=-1)
+
+
+    # The generated functions are rebuilt (from the cache) when unpickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_ExpressionModel__f')
+        state.pop('_ExpressionModel__jac')
+        state.pop('_kernels', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        cache_dir = EXPRESSION_CACHE_DIR if self.cache_dir is None else self.cache_dir
+        self.__compile(_generate(self.expression, cache_dir))
+
+
+
+
+def _generate(expression, cache_dir):
+    # Returns {'param_names': [...], 'source': ...} for expression, where
+    # source defines f(x, *params) and jac(x, *params) (a tuple of the partial
+    # derivatives), and the kernels f_kernel(x, params, out),
+    # f_jac_kernel(x, params, out, jac_out) and jac_kernel(x, params, jac_out)
+    # (see register_kernel).
+    #
+    # Only the derivative expressions are cached. They are validated with
+    # _parse when read back (and may only refer to x, the parameters and the
+    # constants), and the source is always rebuilt from validated parse trees,
+    # so that the contents of the cache directory cannot inject code.
+
+    tree = _parse(expression)
+    normalized = ast.unparse(tree)
+    param_names = _param_names(tree)
+
+    digest = hashlib.sha256((str(_CACHE_VERSION) + normalized).encode()).hexdigest()
+    cache_file = os.path.join(cache_dir, 'expr_' + digest[:32] + '.json')
+
+    derivatives = _read_derivatives(cache_file, normalized, param_names)
+
+    if derivatives is None:
+        derivatives = [_diff(tree, p) for p in param_names]
+
+        # The cache is only an optimization, so failing to write it is not an error
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file, 'w') as f:
+                json.dump({'expression': normalized,
+                           'derivatives': [ast.unparse(d) for d in derivatives]}, f)
+        except OSError as e:
+            print('Could not cache generated fit model in ' + cache_dir + ':\n\t' + str(e))
+
+    args = ', '.join(['x'] + param_names)
+    source = ('def f(' + args + '):\n'
+              '    return ' + normalized + '\n\n'
+              'def jac(' + args + '):\n'
+              '    return (' + ''.join(ast.unparse(d) + ', ' for d in derivatives) + ')\n')
+
+    source += '\n' + _kernel_source(tree, derivatives, param_names)
+
+    return {'param_names': param_names, 'source': source}
+
+
+def _kernel_source(tree, derivatives, param_names):
+    # Source of the loop kernels for the expression tree and its derivatives.
+    # x and the parameters are replaced by x[i] and params[k], so that the
+    # parameter names cannot clash with the names used in the kernels.
+
+    value = _loop_body(tree, param_names)
+
+    source = ('def f_kernel(x, params, out):\n'
+              '    for i in range(x.shape[0]):\n'
+              '        out[i] = ' + value + '\n\n'
+              'def f_jac_kernel(x, params, out, jac_out):\n'
+              '    for i in range(x.shape[0]):\n'
+              '        out[i] = ' + value + '\n')
+
+    jac = ''.join('        jac_out[i, ' + str(k) + '] = ' + _loop_body(d, param_names) + '\n'
+                  for k, d in enumerate(derivatives))
+
+    source += (jac + '\n'
+               'def jac_kernel(x, params, jac_out):\n'
+               '    for i in range(x.shape[0]):\n' + jac)
+
+    return source
+
+
+def _loop_body(tree, param_names):
+    # Unparses tree with x -> x[i] and the parameters -> params[k]
+
+    class Substitute(ast.NodeTransformer):
+        def visit_Call(self, node):
+            # Only the argument, not the function name
+            node.args = [self.visit(arg) for arg in node.args]
+            return node
+
+        def visit_Name(self, node):
+            if node.id == 'x':
+                return ast.Subscript(ast.Name('x', ast.Load()), ast.Name('i', ast.Load()), ast.Load())
+            if node.id in param_names:
+                return ast.Subscript(ast.Name('params', ast.Load()),
+                                     ast.Constant(param_names.index(node.id)), ast.Load())
+            return node
+
+    # The derivatives share subtrees, which must only be substituted once, so
+    # the substitution works on a fresh parse tree
+    return ast.unparse(Substitute().visit(ast.parse(ast.unparse(tree), mode='eval').body))
+
+
+def _read_derivatives(cache_file, normalized, param_names):
+    # Returns the validated parse trees of the cached derivatives of the
+    # expression, or None if they are not cached (or the cache entry is invalid)
+
+    try:
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    allowed = set(['x'] + param_names + list(_CONSTANTS))
+
+    try:
+        if cached['expression'] != normalized or len(cached['derivatives']) != len(param_names):
+            return None
+
+        derivatives = [_parse(d, require_x=False) for d in cached['derivatives']]
+
+    except (KeyError, TypeError, AttributeError, ValueError, SyntaxError):
+        return None
+
+    if any(not set(_names(d)) <= allowed for d in derivatives):
+        return None
+
+    return derivatives
+
+
+def _parse(expression, require_x=True):
+    # Parses and validates expression, returning the ast of its body
+
+    tree = ast.parse(expression.strip(), mode='eval').body
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in _FUNCTIONS \
+               or len(node.args) != 1 or node.keywords:
+                raise ValueError('Unsupported function call ' + ast.unparse(node) + ' in ' + expression)
+        elif isinstance(node, ast.BinOp):
+            if not isinstance(node.op, (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow)):
+                raise ValueError('Unsupported operator in ' + ast.unparse(node))
+        elif isinstance(node, ast.UnaryOp):
+            if not isinstance(node.op, (ast.UAdd, ast.USub)):
+                raise ValueError('Unsupported operator in ' + ast.unparse(node))
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float)):
+                raise ValueError('Unsupported constant ' + repr(node.value) + ' in ' + expression)
+        elif not isinstance(node, (ast.Name, ast.Load, ast.operator, ast.unaryop)):
+            raise ValueError('Unsupported syntax ' + ast.unparse(node) + ' in ' + expression)
+
+    if require_x and 'x' not in _names(tree):
+        raise ValueError('Expression ' + expression + ' does not depend on x')
+
+    return tree
+
+
+def _names(tree):
+    # Variable names in the expression (excluding called functions), in order of appearance
+
+    functions = {id(node.func) for node in ast.walk(tree) if isinstance(node, ast.Call)}
+
+    names = []
+    for node in _walk_in_order(tree):
+        if isinstance(node, ast.Name) and id(node) not in functions and node.id not in names:
+            names.append(node.id)
+
+    return names
+
+
+def _walk_in_order(node):
+    # Depth first traversal in source order (ast.walk is breadth first)
+    yield node
+    for child in ast.iter_child_nodes(node):
+        yield from _walk_in_order(child)
+
+
+def _param_names(tree):
+    return [name for name in _names(tree) if name != 'x' and name not in _CONSTANTS]
+
+
+
+
+# Symbolic differentiation of the expression ast. The helpers below build the
+# result nodes, folding the trivial cases (0 + u, 1 * u, ...) so that the
+# generated derivatives stay short.
+
+def _const(value):
+    return ast.Constant(value)
+
+def _is_const(node, value):
+    return isinstance(node, ast.Constant) and node.value == value
+
+def _add(u, v):
+    if _is_const(u, 0):
+        return v
+    if _is_const(v, 0):
+        return u
+    return ast.BinOp(u, ast.Add(), v)
+
+def _sub(u, v):
+    if _is_const(v, 0):
+        return u
+    if _is_const(u, 0):
+        return _neg(v)
+    return ast.BinOp(u, ast.Sub(), v)
+
+def _mul(u, v):
+    if _is_const(u, 0) or _is_const(v, 0):
+        return _const(0)
+    if _is_const(u, 1):
+        return v
+    if _is_const(v, 1):
+        return u
+    return ast.BinOp(u, ast.Mult(), v)
+
+def _div(u, v):
+    if _is_const(u, 0):
+        return _const(0)
+    if _is_const(v, 1):
+        return u
+    return ast.BinOp(u, ast.Div(), v)
+
+def _pow(u, v):
+    if _is_const(v, 1):
+        return u
+    return ast.BinOp(u, ast.Pow(), v)
+
+def _neg(u):
+    if _is_const(u, 0):
+        return u
+    return ast.UnaryOp(ast.USub(), u)
+
+def _call(name, u):
+    return ast.Call(ast.Name(name, ast.Load()), [u], [])
+
+
+def _depends(node, var):
+    return any(isinstance(n, ast.Name) and n.id == var for n in ast.walk(node))
+
+
+def _diff(node, var):
+    # Derivative of the expression node with respect to the variable var
+
+    if not _depends(node, var):
+        return _const(0)
+
+    if isinstance(node, ast.Name):
+        return _const(1)
+
+    if isinstance(node, ast.UnaryOp):
+        d = _diff(node.operand, var)
+        return _neg(d) if isinstance(node.op, ast.USub) else d
+
+    if isinstance(node, ast.BinOp):
+        u, v = node.left, node.right
+        du, dv = _diff(u, var), _diff(v, var)
+
+        if isinstance(node.op, ast.Add):
+            return _add(du, dv)
+
+        if isinstance(node.op, ast.Sub):
+            return _sub(du, dv)
+
+        if isinstance(node.op, ast.Mult):
+            return _add(_mul(du, v), _mul(u, dv))
+
+        if isinstance(node.op, ast.Div):
+            return _sub(_div(du, v), _div(_mul(u, dv), _pow(v, _const(2))))
+
+        if isinstance(node.op, ast.Pow):
+            if not _depends(v, var):
+                # d(u**n) = n * u**(n-1) * du
+                if isinstance(v, ast.Constant):
+                    exponent = _const(v.value - 1)
+                else:
+                    exponent = _sub(v, _const(1))
+                return _mul(_mul(v, _pow(u, exponent)), du)
+
+            # d(u**v) = u**v * (dv * log(u) + v * du / u)
+            return _mul(node, _add(_mul(dv, _call('log', u)), _div(_mul(v, du), u)))
+
+    if isinstance(node, ast.Call):
+        u = node.args[0]
+        du = _diff(u, var)
+        name = node.func.id
+
+        if name == 'exp':
+            d = node
+        elif name == 'log':
+            d = _div(_const(1), u)
+        elif name == 'sqrt':
+            d = _div(_const(1), _mul(_const(2), node))
+        elif name == 'sin':
+            d = _call('cos', u)
+        elif name == 'cos':
+            d = _neg(_call('sin', u))
+        elif name == 'tan':
+            d = _div(_const(1), _pow(_call('cos', u), _const(2)))
+        elif name == 'arctan':
+            d = _div(_const(1), _add(_const(1), _pow(u, _const(2))))
+        elif name == 'sinh':
+            d = _call('cosh', u)
+        elif name == 'cosh':
+            d = _call('sinh', u)
+        elif name == 'tanh':
+            d = _sub(_const(1), _pow(node, _const(2)))
+        elif name == 'abs':
+            d = _call('sign', u)
+        else:
+            # sign is piecewise constant
+            d = _const(0)
+
+        return _mul(d, du)
+
+    raise ValueError('Cannot differentiate ' + ast.unparse(node))
@@ -6,24 +6,50 @@ from pycftool_FitModel import *
 class Fit(object):
 
     def __init__(self,
-                 x,
-                 y,
+                 data_x,
+                 data_y,
+                 window,
                  fit_model,
-                 fit_y,
                  fit_params,
                  fit_covmat,
                  meta=None
                 ):
 
-        self.x = x
-        self.y = y
+        # References to the full dataset (shared between fits, not copied)
+        # and the index (slice or index array) of the fit window in it
+        self.data_x = data_x
+        self.data_y = data_y
+        self.window = window
+
         self.fit_model = fit_model
-        self.fit_y = fit_y
         self.fit_params = fit_params
         self.fit_covmat = fit_covmat
 
         self.meta = meta
 
+    # The windowed data and fit curve are only materialized when accessed
+    @property
+    def x(self):
+        return self.data_x[self.window]
+
+    @property
+    def y(self):
+        return self.data_y[self.window]
+
+    @property
+    def fit_y(self):
+        return self.fit_model.f(self.x, *self.fit_params)
+
+    def __setstate__(self, state):
+        # Fits pickled by older versions hold their own copies of the data
+        if 'window' not in state:
+            state['data_x'] = state.pop('x')
+            state['data_y'] = state.pop('y')
+            state['window'] = slice(0, len(state['data_x']))
+            state.pop('fit_y', None)
+
+        self.__dict__.update(state)
+
 class ResonanceFit1(Fit):
 
     '''
@@ -31,19 +57,19 @@ class ResonanceFit1(Fit):
     '''
 
     def __init__(self,
-                 x,
-                 y,
+                 data_x,
+                 data_y,
+                 window,
                  fit_model,
-                 fit_y,
                  fit_params,
                  fit_covmat,
                  meta=None
                 ):
 
-        super().__init__(x,
-                         y,
+        super().__init__(data_x,
+                         data_y,
+                         window,
                          fit_model,
-                         fit_y,
                          fit_params,
                          fit_covmat,
                          meta
@@ -56,4 +82,281 @@ class ResonanceFit1(Fit):
         return self.Q == other.Q
 
     def __lt__(self, other):
-        return self.Q < other.Q
\ No newline at end of file
+        return self.Q < other.Q
+
+
+
+
+# Status codes stored for each fit in a FitCollection
+FIT_OK = 0
+FIT_FAILED = 1
+
+
+class FitCollection(object):
+
+    '''
+    Container for the fits of a single dataset.
+
+    The fits are stored as rows of a preallocated (and grown as needed) NumPy
+    structured array holding the model id, parameters, standard errors,
+    covariance matrix, Q, window indices and status of each fit, so that the
+    collection can be filtered and sorted with array operations:
+
+        fits.where(fits.Q > 1e4)
+        fits.sort_by('Q')
+        fits.param('gamma')
+
+    Indexing with an integer and iterating yield lightweight Fit objects
+    (of fit_class) built from the stored row; indexing with a slice, index
+    array or boolean mask returns a new FitCollection.
+    '''
+
+    def __init__(self,
+                 data_x,
+                 data_y,
+                 fit_class=Fit,
+                 meta=None,
+                 fit_models=None,
+                 capacity=64
+                ):
+
+        self.data_x = data_x
+        self.data_y = data_y
+        self.fit_class = fit_class
+        self.meta = meta
+
+        # The model id of each fit indexes into this list
+        self.fit_models = list(fit_models) if fit_models is not None else []
+
+        max_params = max([model.num_params for model in self.fit_models], default=1)
+        self.__rows = np.zeros(capacity, dtype=self.__row_dtype(max_params))
+        self.__len = 0
+
+
+    def __row_dtype(self, max_params):
+        return np.dtype([
+            ('model_id',   np.int32),
+            ('num_params', np.int32),
+            ('params',     np.float64, (max_params,)),
+            ('stderr',     np.float64, (max_params,)),
+            ('covmat',     np.float64, (max_params, max_params)),
+            ('Q',          np.float64),
+            ('start',      np.int64),     # Window slice in the data
+            ('stop',       np.int64),
+            ('index',      object),       # Window index if not a slice (unsorted data)
+            ('status',     np.int8)
+        ])
+
+
+    @property
+    def rows(self):
+        # Structured array of the stored fits
+        return self.__rows[:self.__len]
+
+
+    def __len__(self):
+        return self.__len
+
+
+    def __model_id(self, fit_model):
+        # Look up (or register) the id of a fit model
+        for model_id, model in enumerate(self.fit_models):
+            if model is fit_model or model.name == fit_model.name:
+                return model_id
+
+        self.fit_models.append(fit_model)
+        return len(self.fit_models) - 1
+
+
+    def __reserve(self, length, max_params):
+        # Grow the storage to hold length fits with up to max_params parameters
+
+        width = self.__rows.dtype['params'].shape[0]
+        capacity = len(self.__rows)
+
+        if length <= capacity and max_params <= width:
+            return
+
+        while capacity < length:
+            capacity *= 2
+
+        rows = np.zeros(capacity, dtype=self.__row_dtype(max(width, max_params)))
+
+        # Unused parameter columns are NaN padded (as in append)
+        rows['params'] = np.nan
+        rows['stderr'] = np.nan
+        rows['covmat'] = np.nan
+
+        for name in ['model_id', 'num_params', 'Q', 'start', 'stop', 'index', 'status']:
+            rows[name][:self.__len] = self.rows[name]
+        rows['params'][:self.__len, :width] = self.rows['params']
+        rows['stderr'][:self.__len, :width] = self.rows['stderr']
+        rows['covmat'][:self.__len, :width, :width] = self.rows['covmat']
+
+        self.__rows = rows
+
+
+    def append(self, fit, status=FIT_OK):
+        # Add a Fit object to the collection
+
+        n = len(fit.fit_params)
+        self.__reserve(self.__len + 1, n)
+
+        row = self.__rows[self.__len]
+        row['model_id'] = self.__model_id(fit.fit_model)
+        row['num_params'] = n
+        row['params'] = np.nan
+        row['params'][:n] = fit.fit_params
+        row['covmat'] = np.nan
+        row['covmat'][:n, :n] = fit.fit_covmat
+        row['stderr'] = np.nan
+        row['stderr'][:n] = np.sqrt(np.diag(fit.fit_covmat))
+        row['Q'] = getattr(fit, 'Q', np.nan)
+        row['status'] = status
+
+        if isinstance(fit.window, slice):
+            row['start'], row['stop'] = fit.window.start, fit.window.stop
+            row['index'] = None
+        else:
+            row['start'], row['stop'] = -1, -1
+            row['index'] = fit.window
+
+        self.__len += 1
+
+
+    def extend(self, fits):
+        for fit in fits:
+            self.append(fit)
+
+
+    def delete(self, index):
+        # Remove the fit at index (negative indices count from the end),
+        # returning it
+
+        if not -self.__len <= index < self.__len:
+            raise IndexError('Fit index ' + str(index) + ' out of range')
+        index = index % self.__len
+
+        fit = self[index]
+
+        rows = self.rows
+        rows[index:-1] = rows[index+1:]
+        self.__len -= 1
+
+        return fit
+
+
+    def pop(self, index=-1):
+        return self.delete(index)
+
+
+    def __getitem__(self, index):
+
+        if isinstance(index, (int, np.integer)):
+            return self.__make_fit(self.rows[index])
+
+        return self.__subset(self.rows[index])
+
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self.__make_fit(row)
+
+
+    def __make_fit(self, row):
+        # Build a Fit object from a stored row
+
+        n = row['num_params']
+
+        if row['index'] is None:
+            window = slice(int(row['start']), int(row['stop']))
+        else:
+            window = row['index']
+
+        return self.fit_class(
+            data_x = self.data_x,
+            data_y = self.data_y,
+            window = window,
+            fit_model = self.fit_models[row['model_id']],
+            fit_params = row['params'][:n].copy(),
+            fit_covmat = row['covmat'][:n, :n].copy(),
+            meta = self.meta
+        )
+
+
+    def __subset(self, rows):
+        # New collection (of the same dataset) holding rows
+
+        subset = FitCollection(
+            self.data_x,
+            self.data_y,
+            fit_class = self.fit_class,
+            meta = self.meta,
+            fit_models = self.fit_models,
+            capacity = max(len(rows), 1)
+        )
+        subset.__rows = np.zeros(max(len(rows), 1), dtype=self.__rows.dtype)
+        subset.__rows[:len(rows)] = rows
+        subset.__len = len(rows)
+
+        return subset
+
+
+    # Columns of the collection
+    @property
+    def params(self):
+        return self.rows['params']
+
+    @property
+    def stderr(self):
+        return self.rows['stderr']
+
+    @property
+    def covmat(self):
+        return self.rows['covmat']
+
+    @property
+    def Q(self):
+        return self.rows['Q']
+
+    @property
+    def model_id(self):
+        return self.rows['model_id']
+
+    @property
+    def status(self):
+        return self.rows['status']
+
+
+    def param(self, param_name, column='params'):
+        # Values (or standard errors with column='stderr') of the named
+        # parameter for every fit, NaN for fits whose model does not have it
+
+        values = np.full(self.__len, np.nan)
+
+        for model_id, model in enumerate(self.fit_models):
+            if param_name in model.param_names:
+                rows = self.model_id == model_id
+                values[rows] = self.rows[column][rows, model.param_names.index(param_name)]
+
+        return values
+
+
+    def where(self, mask):
+        # Collection of the fits selected by a boolean mask (or index array)
+        return self.__subset(self.rows[mask])
+
+
+    def sort_by(self, key, reverse=False):
+        # Collection sorted by a column ('Q', 'status', ...) or parameter name
+
+        if key in self.__rows.dtype.names:
+            values = self.rows[key]
+        else:
+            values = self.param(key)
+
+        order = np.argsort(values, kind='stable')
+        if reverse:
+            order = order[::-1]
+
+        return self.__subset(self.rows[order])
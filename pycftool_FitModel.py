@@ -1,4 +1,49 @@
 import numpy as np
+from scipy import sparse
+
+# Numba is optional, used to compile the registered model kernels
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def register_kernel(model, f_kernel, f_jac_kernel=None, jac_kernel=None, cache=True):
+    # Registers compiled kernels for model (a FitModel subclass, or a single
+    # instance), which are then used by FitModel.evaluate, evaluate_jac and
+    # evaluate_with_jac instead of f and jac.
+    #
+    #   f_kernel(x, params, out)              writes the model at x into out
+    #   f_jac_kernel(x, params, out, jac_out) writes the model into out and its
+    #                                         Jacobian (len(x), num_params) into
+    #                                         jac_out in the same pass
+    #   jac_kernel(x, params, jac_out)        writes only the Jacobian
+    #
+    # Kernels are plain Python functions looping over x (so that no temporary
+    # arrays are needed) and are compiled with numba.njit (cached on disk
+    # unless cache is False, which is needed for generated functions that have
+    # no source file). If numba is not installed they are not registered and
+    # the NumPy f and jac are used.
+    #
+    # The kernels are stored on model itself and are not inherited by
+    # subclasses, which may define a different f.
+
+    if numba is None:
+        return
+
+    kernels = [f_kernel, f_jac_kernel, jac_kernel]
+    kernels = tuple(None if k is None else numba.njit(cache=cache)(k) for k in kernels)
+
+    setattr(model, '_kernels', kernels)
+
+
+def _fill(result, out):
+    # Returns result, copied into out if given
+    if out is None:
+        return result
+    out[...] = result
+    return out
+
 
 class FitModel():
 
@@ -25,6 +70,93 @@ class FitModel():
         pass
 
 
+    # Optional analytic Jacobian of f with respect to the parameters.
+    # Subclasses can implement jac(self, x, *params) returning an array of
+    # shape (len(x), num_params), which is then passed to the optimizer.
+    # If left as None the Jacobian is estimated by finite differences.
+    jac = None
+
+
+    @property
+    def kernels(self):
+        # Compiled (f_kernel, f_jac_kernel, jac_kernel) registered for this
+        # instance or for exactly its class (see register_kernel), or None
+        return self.__dict__.get('_kernels', type(self).__dict__.get('_kernels'))
+
+    @property
+    def has_jac(self):
+        # Whether an analytic Jacobian (NumPy or compiled) is available
+        kernels = self.kernels
+        return self.jac is not None or (kernels is not None and kernels[2] is not None)
+
+
+    # evaluate and evaluate_jac have the same call signature as f and jac, so
+    # they can be passed directly to the optimizer. They use the registered
+    # compiled kernels when available and fall back to f and jac otherwise.
+    # Optimizers call them separately (and not always at the same
+    # parameters), so each computes only its own result.
+    def evaluate(self, x, *params, out=None):
+        kernels = self.kernels
+        if kernels is None:
+            return _fill(self.f(x, *params), out)
+
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        if out is None:
+            out = np.empty(len(x))
+
+        kernels[0](x, np.asarray(params, dtype=np.float64), out)
+        return out
+
+    def evaluate_jac(self, x, *params, out=None):
+        kernels = self.kernels
+        if kernels is None or kernels[2] is None:
+            return _fill(self.jac(x, *params), out)
+
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        if out is None:
+            out = np.empty((len(x), self.num_params))
+
+        kernels[2](x, np.asarray(params, dtype=np.float64), out)
+        return out
+
+    def evaluate_with_jac(self, x, params, out=None, jac_out=None):
+        # Returns the model and its Jacobian at x, computed in a single pass
+        # by the fused compiled kernel if there is one (for callers that need
+        # both at the same parameters)
+        kernels = self.kernels
+        if kernels is None or kernels[1] is None:
+            return self.evaluate(x, *params, out=out), self.evaluate_jac(x, *params, out=jac_out)
+
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        if out is None:
+            out = np.empty(len(x))
+        if jac_out is None:
+            jac_out = np.empty((len(x), self.num_params))
+
+        kernels[1](x, np.asarray(params, dtype=np.float64), out, jac_out)
+        return out, jac_out
+
+
+    @staticmethod
+    def from_expression(expression, defaults=None, bounds=None, name=None, param_dict=None):
+        # Fit model from an expression string in x and the parameters, with
+        # a generated analytic Jacobian (see pycftool_Expression)
+        from pycftool_Expression import ExpressionModel
+
+        return ExpressionModel(expression, defaults, bounds, name, param_dict)
+
+
+    def position_param_index(self):
+        # Index of the parameter describing the peak position, used to seed
+        # the initial guess at a found peak. Returns None if there is none.
+        # List of names is hard coded and prioritized in order of label
+        for param_name in ['mu', 'mu0', 'mu1', 'x0']:
+            if param_name in self.param_names:
+                return self.param_names.index(param_name)
+
+        return None
+
+
 
 
 
@@ -54,6 +186,23 @@ class Lorentzian_p1(FitModel):
 
         return lorentzian + background
 
+    def jac(self, x, *params):
+        a, mu, gamma, p0, p1 = params
+
+        dx = x - mu
+        hwhm2 = gamma**2/4
+        denom = dx**2 + hwhm2
+
+        d_a = hwhm2 / denom
+        d_mu = 2 * a * hwhm2 * dx / denom**2 - p1
+        d_gamma = a * (gamma/2) * dx**2 / denom**2
+        d_p0 = np.ones_like(dx)
+        d_p1 = dx
+
+        # Stacked on the last axis so that the Jacobian also broadcasts over
+        # arrays of parameters
+        return np.stack(np.broadcast_arrays(d_a, d_mu, d_gamma, d_p0, d_p1), axis=-1)
+
 
 class Lorentzian_p2(FitModel):
 
@@ -81,3 +230,263 @@ class Lorentzian_p2(FitModel):
         background = p0 + p1 * (x - mu) + p2 * (x - mu)**2
 
         return lorentzian + background
+
+    def jac(self, x, *params):
+        a, mu, gamma, p0, p1, p2 = params
+
+        dx = x - mu
+        hwhm2 = gamma**2/4
+        denom = dx**2 + hwhm2
+
+        d_a = hwhm2 / denom
+        d_mu = 2 * a * hwhm2 * dx / denom**2 - p1 - 2 * p2 * dx
+        d_gamma = a * (gamma/2) * dx**2 / denom**2
+        d_p0 = np.ones_like(dx)
+        d_p1 = dx
+        d_p2 = dx**2
+
+        # Stacked on the last axis so that the Jacobian also broadcasts over
+        # arrays of parameters
+        return np.stack(np.broadcast_arrays(d_a, d_mu, d_gamma, d_p0, d_p1, d_p2), axis=-1)
+
+
+class Lorentzian_multi(FitModel):
+
+    '''
+    Sum of num_peaks Lorentzians with a shared polynomial background of order
+    poly_order about x_ref, for fitting overlapping peaks simultaneously.
+
+    Parameters are [a0, mu0, gamma0, a1, mu1, gamma1, ..., p0, p1, ...].
+    Since each peak only influences the samples near it, the Jacobian is
+    also available as a sparse matrix (see jac_sparsity and jac_sparse)
+    for Backend.fit_global.
+    '''
+
+    def __init__(self, num_peaks, poly_order=1, x_ref=0):
+
+        self.num_peaks = num_peaks
+        self.poly_order = poly_order
+        self.x_ref = x_ref
+
+        param_names = []
+        param_default = []
+        param_min = []
+        param_max = []
+        param_dict = {}
+
+        for k in range(num_peaks):
+            param_names += ['a' + str(k), 'mu' + str(k), 'gamma' + str(k)]
+            param_default += [1, 0, 1]
+            param_min += [-np.inf, 0, 0]
+            param_max += [np.inf, np.inf, np.inf]
+            param_dict.update({
+                'a' + str(k):     'peak ' + str(k) + ' amplitude',
+                'mu' + str(k):    'peak ' + str(k) + ' center',
+                'gamma' + str(k): 'peak ' + str(k) + ' width (FWHM)'
+            })
+
+        for n in range(poly_order + 1):
+            param_names.append('p' + str(n))
+            param_default.append(0)
+            param_min.append(-np.inf)
+            param_max.append(np.inf)
+            param_dict['p' + str(n)] = str(n) + ' order poly coeff (about x_ref)'
+
+        super().__init__(
+            name = 'Lorentzian' + str(num_peaks) + '_poly' + str(poly_order) + '_xref' + repr(float(x_ref)),
+            param_names = param_names,
+            param_default = param_default,
+            param_min = param_min,
+            param_max = param_max,
+            param_dict = param_dict
+        )
+
+    def f(self, x, *params):
+        peaks = np.reshape(params[:3*self.num_peaks], (self.num_peaks, 3))
+        poly = params[3*self.num_peaks:]
+
+        # Polynomial background
+        result = np.polyval(poly[::-1], x - self.x_ref)
+
+        # Accumulate one peak at a time to keep memory at O(len(x))
+        for a, mu, gamma in peaks:
+            result = result + a * (gamma**2/4) / ( (x - mu)**2 + gamma**2/4 )
+
+        return result
+
+    def __peak_jac(self, x, a, mu, gamma):
+        # Derivatives of a single Lorentzian with respect to (a, mu, gamma)
+
+        dx = x - mu
+        hwhm2 = gamma**2/4
+        denom = dx**2 + hwhm2
+
+        return (
+            hwhm2 / denom,
+            2 * a * hwhm2 * dx / denom**2,
+            a * (gamma/2) * dx**2 / denom**2
+        )
+
+    def jac(self, x, *params):
+        return self.jac_sparse(x, params, None).toarray()
+
+    def jac_sparsity(self, x, params, band=10):
+        # Sparsity structure of the Jacobian: peak k only influences the
+        # samples within band FWHMs of its center (at params), while the
+        # background coefficients influence every sample.
+        # Returned as a sparse (len(x), num_params) matrix of ones.
+
+        peaks = np.reshape(params[:3*self.num_peaks], (self.num_peaks, 3))
+
+        rows = []
+        cols = []
+
+        for k, (a, mu, gamma) in enumerate(peaks):
+            near = np.flatnonzero(np.abs(x - mu) <= band * max(gamma, np.finfo(float).eps))
+            for col in range(3*k, 3*k + 3):
+                rows.append(near)
+                cols.append(np.full(len(near), col))
+
+        for n in range(self.poly_order + 1):
+            rows.append(np.arange(len(x)))
+            cols.append(np.full(len(x), 3*self.num_peaks + n))
+
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+
+        sparsity = sparse.csc_matrix(
+            (np.ones(len(rows)), (rows, cols)),
+            shape=(len(x), self.num_params)
+        )
+        sparsity.sort_indices()
+
+        return sparsity
+
+    def jac_sparse(self, x, params, sparsity):
+        # Jacobian as a sparse matrix, evaluated only at the nonzero entries
+        # of sparsity (from jac_sparsity). If sparsity is None the full
+        # Jacobian is computed.
+
+        if sparsity is None:
+            sparsity = sparse.csc_matrix(np.ones((len(x), self.num_params)))
+
+        peaks = np.reshape(params[:3*self.num_peaks], (self.num_peaks, 3))
+
+        values = np.empty(sparsity.nnz)
+
+        for k, (a, mu, gamma) in enumerate(peaks):
+            # Rows of the entries in the columns of peak k (CSC storage)
+            start = sparsity.indptr[3*k]
+            stop = sparsity.indptr[3*k + 1]
+            near = sparsity.indices[start:stop]
+
+            for n, d in enumerate(self.__peak_jac(x[near], a, mu, gamma)):
+                col_start = sparsity.indptr[3*k + n]
+                values[col_start:col_start + len(near)] = d
+
+        for n in range(self.poly_order + 1):
+            col = 3*self.num_peaks + n
+            start = sparsity.indptr[col]
+            stop = sparsity.indptr[col + 1]
+            values[start:stop] = (x[sparsity.indices[start:stop]] - self.x_ref)**n
+
+        return sparse.csc_matrix(
+            (values, sparsity.indices, sparsity.indptr),
+            shape=sparsity.shape
+        )
+
+
+
+
+# Compiled kernels for the built-in models (see register_kernel)
+
+def _lorentzian_p1_f(x, params, out):
+    a, mu, gamma, p0, p1 = params[0], params[1], params[2], params[3], params[4]
+    hwhm2 = gamma * gamma / 4
+
+    for i in range(x.shape[0]):
+        dx = x[i] - mu
+        out[i] = a * hwhm2 / (dx * dx + hwhm2) + p0 + p1 * dx
+
+
+def _lorentzian_p1_f_jac(x, params, out, jac_out):
+    a, mu, gamma, p0, p1 = params[0], params[1], params[2], params[3], params[4]
+    hwhm2 = gamma * gamma / 4
+
+    for i in range(x.shape[0]):
+        dx = x[i] - mu
+        inv = 1 / (dx * dx + hwhm2)
+        lorentzian = hwhm2 * inv
+
+        out[i] = a * lorentzian + p0 + p1 * dx
+
+        jac_out[i, 0] = lorentzian
+        jac_out[i, 1] = 2 * a * lorentzian * dx * inv - p1
+        jac_out[i, 2] = a * (gamma / 2) * dx * dx * inv * inv
+        jac_out[i, 3] = 1
+        jac_out[i, 4] = dx
+
+
+def _lorentzian_p1_jac(x, params, jac_out):
+    a, mu, gamma, p1 = params[0], params[1], params[2], params[4]
+    hwhm2 = gamma * gamma / 4
+
+    for i in range(x.shape[0]):
+        dx = x[i] - mu
+        inv = 1 / (dx * dx + hwhm2)
+        lorentzian = hwhm2 * inv
+
+        jac_out[i, 0] = lorentzian
+        jac_out[i, 1] = 2 * a * lorentzian * dx * inv - p1
+        jac_out[i, 2] = a * (gamma / 2) * dx * dx * inv * inv
+        jac_out[i, 3] = 1
+        jac_out[i, 4] = dx
+
+
+def _lorentzian_p2_f(x, params, out):
+    a, mu, gamma, p0, p1, p2 = params[0], params[1], params[2], params[3], params[4], params[5]
+    hwhm2 = gamma * gamma / 4
+
+    for i in range(x.shape[0]):
+        dx = x[i] - mu
+        out[i] = a * hwhm2 / (dx * dx + hwhm2) + p0 + p1 * dx + p2 * dx * dx
+
+
+def _lorentzian_p2_f_jac(x, params, out, jac_out):
+    a, mu, gamma, p0, p1, p2 = params[0], params[1], params[2], params[3], params[4], params[5]
+    hwhm2 = gamma * gamma / 4
+
+    for i in range(x.shape[0]):
+        dx = x[i] - mu
+        inv = 1 / (dx * dx + hwhm2)
+        lorentzian = hwhm2 * inv
+
+        out[i] = a * lorentzian + p0 + p1 * dx + p2 * dx * dx
+
+        jac_out[i, 0] = lorentzian
+        jac_out[i, 1] = 2 * a * lorentzian * dx * inv - p1 - 2 * p2 * dx
+        jac_out[i, 2] = a * (gamma / 2) * dx * dx * inv * inv
+        jac_out[i, 3] = 1
+        jac_out[i, 4] = dx
+        jac_out[i, 5] = dx * dx
+
+
+def _lorentzian_p2_jac(x, params, jac_out):
+    a, mu, gamma, p1, p2 = params[0], params[1], params[2], params[4], params[5]
+    hwhm2 = gamma * gamma / 4
+
+    for i in range(x.shape[0]):
+        dx = x[i] - mu
+        inv = 1 / (dx * dx + hwhm2)
+        lorentzian = hwhm2 * inv
+
+        jac_out[i, 0] = lorentzian
+        jac_out[i, 1] = 2 * a * lorentzian * dx * inv - p1 - 2 * p2 * dx
+        jac_out[i, 2] = a * (gamma / 2) * dx * dx * inv * inv
+        jac_out[i, 3] = 1
+        jac_out[i, 4] = dx
+        jac_out[i, 5] = dx * dx
+
+
+register_kernel(Lorentzian_p1, _lorentzian_p1_f, _lorentzian_p1_f_jac, _lorentzian_p1_jac)
+register_kernel(Lorentzian_p2, _lorentzian_p2_f, _lorentzian_p2_f_jac, _lorentzian_p2_jac)
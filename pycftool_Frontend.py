@@ -2,7 +2,14 @@ import ipywidgets as widgets
 import matplotlib.pyplot as plt
 import numpy as np
 
+import asyncio
+import time
+
 from IPython.display import display
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba
+
+from plot_lod import LODLine
 
 from pycftool_Backend import *
 from pycftool_Fit import *
@@ -22,14 +29,49 @@ class Frontend():
         with self.output:
             self.fig, self.ax = plt.subplots(constrained_layout=True, figsize=(6, 4))
 
+        # The data line is decimated to the axis width and updated from a
+        # precomputed min/max pyramid when the x limits change (see plot_lod)
         self.line, = self.ax.plot(self.backend.x, self.backend.y, 'k')
+        self.line_lod = LODLine(self.line, self.backend.x, self.backend.y)
         self.fig.canvas.toolbar_position = 'bottom'
         self.ax.grid(True)
 
-        # list of all plt.line objects for future generated fits
-        self.fit_curve_lines = []
-        # Line object for the current fit line
-        self.current_fit_line, = self.ax.plot([])
+        # The accepted fits are drawn as a single LineCollection, with one
+        # segment (and color) per fit in the same order as backend.fits. The
+        # colors are kept in a preallocated array that grows geometrically
+        # (num_fit_curves rows are in use). Each change still passes all
+        # segments and colors to the collection (set_segments/set_color), so
+        # an update is O(number of fits), but as a single artist rather than
+        # one Line2D per fit
+        self.fit_curve_segments = []
+        self.num_fit_curves = 0
+        self.fit_curve_colors = np.empty((16, 4))
+        self.fit_curves = LineCollection([], linewidths=2)
+        self.ax.add_collection(self.fit_curves, autolim=False)
+
+        # Persistent line objects for the data being fitted and the current
+        # fit line. They are updated with set_data and, being animated, are
+        # not drawn with the rest of the figure but blitted over a cached
+        # background of the static artists (see __blit)
+        self.fit_region_data_line, = self.ax.plot([], [], 'ko', animated=True)
+        self.current_fit_line, = self.ax.plot([], [], 'C0', linewidth=2, animated=True)
+
+        # Live preview of the model with the current parameter inputs,
+        # evaluated on a grid over the fit window (at most preview_points or
+        # two points per pixel) into a preallocated buffer and redrawn at
+        # most once per preview_interval seconds (see __preview_params)
+        self.preview_line, = self.ax.plot([], [], 'C2--', animated=True)
+        self.live_preview = True
+        self.preview_points = 2000
+        self.preview_interval = 1/60
+        self.preview_x = None
+        self.preview_y = None
+        self.last_preview_time = 0
+        self.preview_handle = None
+
+        # Background recaptured after every full draw (None when out of date)
+        self.background = None
+        self.fig.canvas.mpl_connect('draw_event', self.__on_draw)
 
 
         # High-level control box
@@ -66,6 +108,24 @@ class Frontend():
         # Watch the dropdown
         self.fitmodel_dropdown.observe(self.__init_FitModel, 'value')
 
+        # Robust fitting options (see fit_window): the loss function and the
+        # threshold for masking outliers and refitting (0 to keep all points)
+        self.loss_dropdown = widgets.Dropdown(value=self.backend.fit_loss,
+                                              options=self.backend.fit_losses,
+                                              description='Loss',
+                                              disabled=True
+                                             )
+        self.outlier_threshold_input = widgets.FloatText(value=self.backend.outlier_threshold or 0,
+                                                         description='Outlier cut',
+                                                         continuous_update=False,
+                                                         disabled=True
+                                                        )
+
+        self.loss_dropdown.observe(self.__update_fit_options, 'value')
+        self.outlier_threshold_input.observe(self.__update_fit_options, 'value')
+
+        self.fit_options_box = widgets.VBox([self.loss_dropdown, self.outlier_threshold_input])
+
 
         # For each parameter, generate an input floattext widget
         # Create an observer and write the parameter values to the backend
@@ -89,6 +149,7 @@ class Frontend():
 
             # Observe the input widgets
             self.param_input_widgets[k].observe(self.backend.update_param, 'value')
+            self.param_input_widgets[k].observe(self.__preview_params, 'value')
 
 
         # Make the box of parameter input widgets
@@ -97,13 +158,13 @@ class Frontend():
         )
 
         # Join the dropdown and fit parameter widgets
-        self.fit_box = widgets.VBox([self.fitmodel_dropdown, self.param_box])
+        self.fit_box = widgets.VBox([self.fitmodel_dropdown, self.fit_options_box, self.param_box])
 
         # Fit results widget box
         self.trigger_fit_button = widgets.Button(description='Run fit', disabled=True)
 
         # Attempt to fit when triggered
-        self.trigger_fit_button.on_click(self.backend.fit_data)
+        self.trigger_fit_button.on_click(self.backend.request_fit)
 
         # Create a set of output text widgets to display the results
         self.param_output_widgets = []
@@ -371,7 +432,7 @@ class Frontend():
         self.ctrl_b2.disabled=False
 
         self.fitmodel_dropdown.disabled = False
-        for param in self.param_box.children:
+        for param in self.param_box.children + self.fit_options_box.children:
             param.disabled = False
 
         # Set the selected value to 0 and disable the selection box
@@ -384,18 +445,20 @@ class Frontend():
         self.trigger_fit_button.disabled = False
 
         # Get the data in the domain of the fit range
-        self.backend.fit_x, self.backend.fit_y = self.backend.get_data_in_range(self.ax.get_xlim())
+        self.backend.set_fit_range(self.ax.get_xlim())
+        self.__set_preview_grid()
 
         # Update the plot
         self.line.set_alpha(0.1)
-        self.fit_region_data_line, = self.ax.plot(self.backend.fit_x, self.backend.fit_y, 'ko')
+        self.fit_region_data_line.set_data(self.backend.fit_x, self.backend.fit_y)
 
-        # Make new current_fit_line
-        self.current_fit_line, = plt.plot([])
+        # Clear the current fit line
+        self.current_fit_line.set_data([], [])
 
-        # Remove the accepted fit lines
-        for line in self.fit_curve_lines:
-            line.remove()
+        # Hide the accepted fit lines
+        self.fit_curves.set_visible(False)
+
+        self.__redraw()
 
 
     def __goto_SearchMode(self, change):
@@ -404,7 +467,7 @@ class Frontend():
         self.ctrl_b2.disabled=True
 
         self.fitmodel_dropdown.disabled = True
-        for param in self.param_box.children:
+        for param in self.param_box.children + self.fit_options_box.children:
             param.disabled = True
 
         # Disable the fit buttons
@@ -415,15 +478,17 @@ class Frontend():
         self.selection_dropdown.disabled = False
 
         self.line.set_alpha(1)
-        self.fit_region_data_line.remove()
+        self.fit_region_data_line.set_data([], [])
+        self.__clear_preview()
+
+        # Clear the current fit line
+        self.current_fit_line.set_data([], [])
 
-        # Remove the current fit line
-        self.current_fit_line.remove()
 
+        # Show the accepted fit lines
+        self.fit_curves.set_visible(True)
 
-        # Add back the accepted fit lines
-        for line in self.fit_curve_lines:
-            self.ax.add_line(line)
+        self.__redraw()
 
 
     def __init_FitModel(self, change):
@@ -470,6 +535,7 @@ class Frontend():
 
                 # Observe the input widgets
                 self.param_input_widgets[k].observe(self.backend.update_param, 'value')
+                self.param_input_widgets[k].observe(self.__preview_params, 'value')
 
 
         # Update the widget container to include updated list
@@ -477,6 +543,15 @@ class Frontend():
         self.output_box.children = [self.trigger_fit_button, self.accept_fit_button] + self.param_output_widgets
 
 
+    def __update_fit_options(self, change):
+
+        self.backend.fit_loss = self.loss_dropdown.value
+
+        # A threshold of 0 (or less) disables outlier masking
+        threshold = self.outlier_threshold_input.value
+        self.backend.outlier_threshold = threshold if threshold > 0 else None
+
+
     def update_results(self):
         # Method to update the fit line of the data
 
@@ -485,11 +560,12 @@ class Frontend():
             output_widget.value = output
 
         # Plot the fit line
-        self.current_fit_line.remove()
-        self.current_fit_line, = self.ax.plot(self.backend.fit_x, self.backend.fit_result, 'C0', linewidth=2)
+        self.current_fit_line.set_data(self.backend.fit_x, self.backend.fit_result)
+        self.__blit()
 
-        # Enable the accept fit button
-        self.accept_fit_button.disabled = False
+        # Enable the accept fit button (outside of auto mode, which has its own)
+        if self.auto_exit_button.disabled:
+            self.accept_fit_button.disabled = False
 
 
 
@@ -497,20 +573,15 @@ class Frontend():
 
         # Append the fitclass
         self.backend.fits.append(
-            self.backend.fit_class(
-                x = self.backend.fit_x,
-                y = self.backend.fit_y,
+            self.backend.new_fit(
+                window = self.backend.fit_window,
                 fit_model = self.backend.cur_fitmodel,
-                fit_y = self.backend.fit_result,
                 fit_params = self.backend.fit_params,
-                fit_covmat = self.backend.fit_covmat,
-                meta=self.backend.meta
+                fit_covmat = self.backend.fit_covmat
             )
         )
 
-        self.fit_curve_lines.append(
-            self.current_fit_line
-        )
+        self.__add_fit_curve()
 
 
         # Once the fit is accepted, refresh the fit list for selection
@@ -523,9 +594,9 @@ class Frontend():
 
     def __select_fit(self, change):
 
-        # Reset all fits to old color
-        for line in self.fit_curve_lines:
-            line.set_color('C0')
+        # Reset the previously selected fit to the old color
+        if self.selected_fit_index is not None:
+            self.fit_curve_colors[self.selected_fit_index] = to_rgba('C0')
 
         if change.new is not None:
             # Enable the delete button
@@ -533,7 +604,10 @@ class Frontend():
 
             # Change the color of the selected line
             #print('New curve selected at ' + str(change.new))
-            self.fit_curve_lines[change.new].set_color('C1')
+            self.fit_curve_colors[change.new] = to_rgba('C1')
+
+        self.fit_curves.set_color(self.fit_curve_colors[:self.num_fit_curves])
+        self.__redraw()
 
         # Disable the delete button when no fit is selected
         if change.new is None:
@@ -551,11 +625,15 @@ class Frontend():
         # Delete the fit in the backend
         self.backend.delete_fit(self.selected_fit_index)
 
-        # Remove the line from the gui list
-        line_to_remove = self.fit_curve_lines.pop(self.selected_fit_index)
+        # Remove the line from the fit curves, shifting the later colors down
+        i, n = self.selected_fit_index, self.num_fit_curves
+        self.fit_curve_segments.pop(i)
+        self.fit_curve_colors[i:n-1] = self.fit_curve_colors[i+1:n]
+        self.num_fit_curves -= 1
+        self.selected_fit_index = None
 
-        # Delete the line from the gui itself
-        line_to_remove.remove()
+        self.__update_fit_curves()
+        self.__redraw()
 
         print('Successfuly removed line')
 
@@ -582,6 +660,7 @@ class Frontend():
             self.peaks_line.set_data(self.backend.x[self.backend.peak_idxs],
                                      self.backend.y[self.backend.peak_idxs]
                                     )
+            self.__redraw()
 
             # Enable clear peaks
             self.reset_peaks_button.disabled = False
@@ -596,6 +675,7 @@ class Frontend():
     def __clear_peaks(self, change):
         # Remove the peaks from the plot
         self.peaks_line.set_data([],[])
+        self.__redraw()
 
         # Clear the backend
         self.backend.peak_idxs = []
@@ -630,7 +710,7 @@ class Frontend():
         self.ctrl_b1.disabled=True # disable the fit data in range button
 
         self.fitmodel_dropdown.disabled = False
-        for param in self.param_box.children:
+        for param in self.param_box.children + self.fit_options_box.children:
             param.disabled = False
 
         # Set the selected value to 0 and disable the selection box
@@ -642,8 +722,8 @@ class Frontend():
         # Update the plot
         self.line.set_alpha(0.1)
 
-        # Make new current_fit_line
-        self.current_fit_line, = plt.plot([])
+        # Clear the current fit line
+        self.current_fit_line.set_data([], [])
 
         # Go to the first peak
         self.__goto_next_peak()
@@ -670,7 +750,7 @@ class Frontend():
         self.ctrl_b1.disabled=False # disable the fit data in range button
 
         self.fitmodel_dropdown.disabled = True
-        for param in self.param_box.children:
+        for param in self.param_box.children + self.fit_options_box.children:
             param.disabled = True
 
         # Re-enable the dropdown Button
@@ -682,14 +762,12 @@ class Frontend():
         # Reset the main line color alpha
         self.line.set_alpha(1)
 
-        # Clear out the fit data line
-        try:
-            self.fit_region_data_line.remove()
-        except:
-            pass
+        # Clear out the fit data line and preview
+        self.fit_region_data_line.set_data([], [])
+        self.__clear_preview()
 
-        # Remove the current fit line
-        self.current_fit_line.remove()
+        # Clear the current fit line
+        self.current_fit_line.set_data([], [])
 
         # Reset the x axis
         x_limits = (np.amin(self.backend.x), np.amax(self.backend.x))
@@ -701,9 +779,7 @@ class Frontend():
         y_margin = (y_limits[1] - y_limits[0]) * 0.05  # 5% of window on each end
         self.ax.set_ylim(y_limits[0]-y_margin, y_limits[1]+y_margin)
 
-        # Add back the accepted fit lines
-        for line in self.fit_curve_lines:
-            self.ax.add_line(line)
+        self.__redraw()
 
 
     def __goto_next_peak(self):
@@ -723,15 +799,15 @@ class Frontend():
             # Set the window
             self.__rescale_window(None) # This method also updates the fit data in the backend
 
-            # Update the parameter for the peak position
-            # List of names is hard coded and prioritized in order of label
-            for param_name in ['mu', 'mu0', 'mu1', 'x0']:
-                try:
-                    position_param_index = self.backend.cur_fitmodel.param_names.index(param_name)
-                    self.param_box.children[position_param_index].value = self.backend.x[self.cur_peak_idx]
-                    break
-                except:
-                    pass
+            # Update the parameters with the initial guess for the peak
+            p0 = self.backend.guess_params(
+                self.backend.cur_fitmodel,
+                self.cur_peak_idx,
+                self.backend.fit_window,
+                self.backend.warm_start
+            )
+            for param_widget, value in zip(self.param_box.children, p0):
+                param_widget.value = value
 
 
             # Run a fit onthe window
@@ -740,22 +816,25 @@ class Frontend():
 
     def __auto_accept(self, change):
 
+        # The fit of this peak may have failed or still be running
+        if self.backend.fit_params is None:
+            print('No fit to accept yet')
+            return
+
         # Append the fitclass
         self.backend.fits.append(
-            self.backend.fit_class(
-                x = self.backend.fit_x,
-                y = self.backend.fit_y,
+            self.backend.new_fit(
+                window = self.backend.fit_window,
                 fit_model = self.backend.cur_fitmodel,
-                fit_y = self.backend.fit_result,
                 fit_params = self.backend.fit_params,
-                fit_covmat = self.backend.fit_covmat,
-                meta=self.backend.meta
+                fit_covmat = self.backend.fit_covmat
             )
         )
 
-        self.fit_curve_lines.append(
-            self.current_fit_line
-        )
+        self.__add_fit_curve()
+
+        # Warm-start the guess for the next peak from the accepted fit
+        self.backend.warm_start = self.backend.fits[-1]
 
 
         # Once the fit is accepted, refresh the fit list for selection
@@ -773,7 +852,7 @@ class Frontend():
 
     def __auto_refit(self, change):
 
-        self.backend.fit_data(None)
+        self.backend.request_fit(None)
         self.accept_fit_button.disabled = True
 
 
@@ -787,16 +866,11 @@ class Frontend():
         )
 
         # Change the fit data to whatever is in the range
-        self.backend.fit_x, self.backend.fit_y = self.backend.get_data_in_range(
-            self.data_range
-        )
+        self.backend.set_fit_range(self.data_range)
+        self.__set_preview_grid()
 
         # Reset the data line
-        try:
-            self.fit_region_data_line.remove()
-        except:
-            pass
-        self.fit_region_data_line, = self.ax.plot(self.backend.fit_x, self.backend.fit_y, 'ko')
+        self.fit_region_data_line.set_data(self.backend.fit_x, self.backend.fit_y)
 
 
         # Set the x axis
@@ -806,4 +880,134 @@ class Frontend():
         # Set the y axis
         y_limits = (np.amin(self.backend.fit_y), np.amax(self.backend.fit_y))
         y_margin = (y_limits[1] - y_limits[0]) * 0.05  # 5% of window on each end
-        self.ax.set_ylim(y_limits[0]-y_margin, y_limits[1]+y_margin)
\ No newline at end of file
+        self.ax.set_ylim(y_limits[0]-y_margin, y_limits[1]+y_margin)
+
+        self.__redraw()
+
+
+
+    def __add_fit_curve(self):
+
+        # Add the last accepted fit to the (static) fit curves
+        fit = self.backend.fits[-1]
+        if self.num_fit_curves == len(self.fit_curve_colors):
+            self.fit_curve_colors = np.concatenate([self.fit_curve_colors, np.empty_like(self.fit_curve_colors)])
+
+        self.fit_curve_segments.append(np.column_stack([fit.x, fit.fit_y]))
+        self.fit_curve_colors[self.num_fit_curves] = to_rgba('C0')
+        self.num_fit_curves += 1
+
+        self.__update_fit_curves()
+
+        self.current_fit_line.set_data([], [])
+
+
+    def __update_fit_curves(self):
+        self.fit_curves.set_segments(self.fit_curve_segments)
+        self.fit_curves.set_color(self.fit_curve_colors[:self.num_fit_curves])
+
+
+
+    def __redraw(self):
+
+        # Request a full redraw of the figure, after changing the static
+        # artists or the axes limits. The background is recaptured (and the
+        # animated artists drawn) once the draw happens, in __on_draw.
+        self.background = None
+        self.fig.canvas.draw_idle()
+
+
+    def __on_draw(self, event):
+
+        # Cache the static background and draw the animated artists over it
+        self.background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+        self.__draw_animated()
+
+
+    def __draw_animated(self):
+        self.ax.draw_artist(self.fit_region_data_line)
+        self.ax.draw_artist(self.preview_line)
+        self.ax.draw_artist(self.current_fit_line)
+
+
+    def __blit(self):
+
+        # Redraw only the animated artists over the cached background
+        canvas = self.fig.canvas
+
+        if self.background is None or not canvas.supports_blit:
+            canvas.draw_idle()
+            return
+
+        canvas.restore_region(self.background)
+        self.__draw_animated()
+        canvas.blit(self.ax.bbox)
+
+
+
+    def __set_preview_grid(self):
+
+        # Preallocate the preview grid and buffer for the new fit window
+        fit_x = self.backend.fit_x
+
+        if len(fit_x) == 0:
+            self.__clear_preview()
+            return
+
+        num_points = min(len(fit_x), self.preview_points, 2 * int(self.ax.bbox.width))
+        self.preview_x = np.linspace(np.amin(fit_x), np.amax(fit_x), max(num_points, 2))
+        self.preview_y = np.empty(len(self.preview_x))
+
+        self.__update_preview()
+
+
+    def __clear_preview(self):
+
+        if self.preview_handle is not None:
+            self.preview_handle.cancel()
+            self.preview_handle = None
+
+        self.preview_x = None
+        self.preview_y = None
+        self.preview_line.set_data([], [])
+
+
+    def __preview_params(self, change):
+
+        # Throttle the preview to one redraw per preview_interval, making
+        # sure the last edit is always shown
+        if not self.live_preview or self.preview_x is None or self.preview_handle is not None:
+            return
+
+        wait = self.last_preview_time + self.preview_interval - time.monotonic()
+
+        if wait <= 0:
+            self.__update_preview()
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.__update_preview()
+            return
+
+        self.preview_handle = loop.call_later(wait, self.__update_preview)
+
+
+    def __update_preview(self):
+
+        self.preview_handle = None
+        self.last_preview_time = time.monotonic()
+
+        if self.preview_x is None:
+            return
+
+        # Evaluate the model in place (see FitModel.evaluate)
+        try:
+            self.backend.cur_fitmodel.evaluate(self.preview_x, *self.backend.param_vect, out=self.preview_y)
+        except Exception:
+            # e.g. while the parameter inputs are being rebuilt for a new model
+            return
+
+        self.preview_line.set_data(self.preview_x, self.preview_y)
+        self.__blit()
@@ -0,0 +1,304 @@
+import numpy as np
+
+import json
+import zipfile
+
+import pycftool_Fit
+from pycftool_FitModel import *
+
+
+class ResultsStore():
+
+    '''
+    Columnar results file for the fits of a single dataset.
+
+    The file is a .npz (zip) archive. The raw data is stored once and the fits
+    are stored as columns in chunks, one chunk per call to append:
+
+        data_x, data_y, meta             : the dataset and its metadata (JSON)
+        fits_NNNNN/model_name            : (n,) names of the fit models
+        fits_NNNNN/num_params            : (n,) number of parameters of each fit
+        fits_NNNNN/params                : (n, max_params) fit parameters (NaN padded)
+        fits_NNNNN/covmat                : (n, max_params, max_params) covariances
+        fits_NNNNN/window                : (n, 2) start/stop indices of the
+                                           window in the data (-1 if the window
+                                           is not a slice, i.e. unsorted data)
+        fits_NNNNN/bounds                : (n, 2) x limits of the window
+        fits_NNNNN/models                : JSON dict of model name -> param names
+        fits_NNNNN/fit_class             : name of the Fit class
+
+    New chunks are appended to the archive without rewriting it, and every
+    column can be read on its own without loading the rest of the file.
+    '''
+
+    def __init__(self, filename):
+
+        self.filename = filename
+
+
+    def __read(self, zf, name):
+        # Read a single array from the archive
+        with zf.open(name + '.npy') as f:
+            return np.lib.format.read_array(f, allow_pickle=False)
+
+
+    def __write(self, zf, name, array):
+        # Write a single array to the archive
+        with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+
+    def chunks(self):
+        # Names of the chunks of fits in the file, in the order they were written
+        with zipfile.ZipFile(self.filename, 'r') as zf:
+            names = zf.namelist()
+
+        return sorted({name.split('/')[0] for name in names if name.startswith('fits_')})
+
+
+    def write(self, data_x, data_y, meta, fits):
+        # Create (or overwrite) the file with the dataset and an initial set of fits
+
+        with zipfile.ZipFile(self.filename, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            self.__write(zf, 'data_x', data_x)
+            self.__write(zf, 'data_y', data_y)
+            self.__write(zf, 'meta', json.dumps(meta, default=_json_default))
+
+        self.append(fits)
+
+
+    def append(self, fits):
+        # Add a list of Fit objects (or a FitCollection) to the file as a new chunk
+
+        if len(fits) == 0:
+            return
+
+        chunk = 'fits_%05d' % len(self.chunks())
+
+        if isinstance(fits, pycftool_Fit.FitCollection):
+            columns = _collection_columns(fits)
+        else:
+            columns = _fit_list_columns(fits)
+
+        with zipfile.ZipFile(self.filename, 'a', compression=zipfile.ZIP_DEFLATED) as zf:
+            for name, column in columns.items():
+                self.__write(zf, chunk + '/' + name, column)
+
+
+    def load_data(self):
+        # Returns the dataset (data_x, data_y, meta)
+
+        with zipfile.ZipFile(self.filename, 'r') as zf:
+            data_x = self.__read(zf, 'data_x')
+            data_y = self.__read(zf, 'data_y')
+            meta = json.loads(str(self.__read(zf, 'meta')))
+
+        return data_x, data_y, meta
+
+
+    def column(self, name):
+        # Returns a single column (e.g. 'params' or 'model_name') for all fits,
+        # reading only that column from each chunk
+
+        with zipfile.ZipFile(self.filename, 'r') as zf:
+            columns = [self.__read(zf, chunk + '/' + name) for chunk in self.chunks()]
+
+        if len(columns) == 0:
+            return np.array([])
+
+        # Pad the parameter columns to a common width
+        if name in ['params', 'covmat']:
+            width = max(column.shape[1] for column in columns)
+            padded = []
+            for column in columns:
+                pad = [(0, 0)] + [(0, width - column.shape[1])] * (column.ndim - 1)
+                padded.append(np.pad(column, pad, constant_values=np.nan))
+            columns = padded
+
+        return np.concatenate(columns)
+
+
+    def param(self, param_name):
+        # Returns the values of the named parameter for all fits
+        # (NaN for fits whose model does not have that parameter)
+
+        values = []
+
+        with zipfile.ZipFile(self.filename, 'r') as zf:
+            for chunk in self.chunks():
+                models = json.loads(str(self.__read(zf, chunk + '/models')))
+                model_name = self.__read(zf, chunk + '/model_name')
+                params = self.__read(zf, chunk + '/params')
+
+                chunk_values = np.full(len(model_name), np.nan)
+                for name, param_names in models.items():
+                    if param_name in param_names:
+                        rows = model_name == name
+                        chunk_values[rows] = params[rows, param_names.index(param_name)]
+
+                values.append(chunk_values)
+
+        if len(values) == 0:
+            return np.array([])
+
+        return np.concatenate(values)
+
+
+    def load_fits(self, fit_class=None, fit_models=None):
+        # Rebuilds the list of Fit objects.
+        # fit_class overrides the stored Fit class, fit_models is an optional
+        # list of FitModel objects to use (the built-in models are used otherwise)
+
+        data_x, data_y, meta = self.load_data()
+        models = _model_lookup(fit_models)
+
+        fits = []
+
+        with zipfile.ZipFile(self.filename, 'r') as zf:
+            for chunk in self.chunks():
+
+                if fit_class is None:
+                    cls = getattr(pycftool_Fit, str(self.__read(zf, chunk + '/fit_class')), pycftool_Fit.Fit)
+                else:
+                    cls = fit_class
+
+                model_name = self.__read(zf, chunk + '/model_name')
+                num_params = self.__read(zf, chunk + '/num_params')
+                params = self.__read(zf, chunk + '/params')
+                covmat = self.__read(zf, chunk + '/covmat')
+                window = self.__read(zf, chunk + '/window')
+                bounds = self.__read(zf, chunk + '/bounds')
+
+                for i in range(len(model_name)):
+
+                    n = num_params[i]
+
+                    if window[i, 0] >= 0:
+                        index = slice(window[i, 0], window[i, 1])
+                    else:
+                        index = np.flatnonzero(np.logical_and(data_x >= bounds[i, 0], data_x <= bounds[i, 1]))
+
+                    fits.append(
+                        cls(
+                            data_x = data_x,
+                            data_y = data_y,
+                            window = index,
+                            fit_model = models[str(model_name[i])],
+                            fit_params = params[i, :n],
+                            fit_covmat = covmat[i, :n, :n],
+                            meta = meta
+                        )
+                    )
+
+        return fits
+
+
+    def load(self, fit_class=None, fit_models=None):
+        # Loads the whole file in the same layout as the original pickled results
+
+        data_x, data_y, meta = self.load_data()
+
+        return {
+            'data_x' : data_x,
+            'data_y' : data_y,
+            'meta'   : meta,
+            'fits'   : self.load_fits(fit_class, fit_models)
+        }
+
+
+
+
+def _fit_list_columns(fits):
+    # Columns of a chunk for a list of Fit objects
+
+    num_params = np.array([len(fit.fit_params) for fit in fits])
+    max_params = np.amax(num_params)
+
+    params = np.full((len(fits), max_params), np.nan)
+    covmat = np.full((len(fits), max_params, max_params), np.nan)
+    window = np.full((len(fits), 2), -1)
+    bounds = np.full((len(fits), 2), np.nan)
+    models = {}
+
+    for i, fit in enumerate(fits):
+        n = num_params[i]
+        params[i, :n] = fit.fit_params
+        covmat[i, :n, :n] = fit.fit_covmat
+
+        if len(fit.x) > 0:
+            bounds[i] = (np.amin(fit.x), np.amax(fit.x))
+        if isinstance(fit.window, slice):
+            window[i] = (fit.window.start, fit.window.stop)
+
+        models[fit.fit_model.name] = list(fit.fit_model.param_names)
+
+    return {
+        'model_name' : np.array([fit.fit_model.name for fit in fits]),
+        'num_params' : num_params,
+        'params'     : params,
+        'covmat'     : covmat,
+        'window'     : window,
+        'bounds'     : bounds,
+        'models'     : json.dumps(models),
+        'fit_class'  : type(fits[0]).__name__
+    }
+
+
+def _collection_columns(fits):
+    # Columns of a chunk for a FitCollection, taken directly from its arrays
+
+    rows = fits.rows
+    max_params = np.amax(rows['num_params'])
+
+    is_slice = np.array([index is None for index in rows['index']])
+    window = np.where(is_slice[:, None], np.stack([rows['start'], rows['stop']], axis=1), -1)
+
+    # Bounds of the windows (NaN for empty windows)
+    bounds = np.full((len(rows), 2), np.nan)
+
+    nonempty = is_slice & (rows['stop'] > rows['start'])
+    bounds[nonempty, 0] = fits.data_x[rows['start'][nonempty]]
+    bounds[nonempty, 1] = fits.data_x[rows['stop'][nonempty] - 1]
+
+    for i in np.flatnonzero(~is_slice):
+        x = fits.data_x[rows['index'][i]]
+        if len(x) > 0:
+            bounds[i] = (np.amin(x), np.amax(x))
+
+    model_names = np.array([model.name for model in fits.fit_models])
+    models = {fits.fit_models[model_id].name: list(fits.fit_models[model_id].param_names)
+              for model_id in np.unique(rows['model_id'])}
+
+    return {
+        'model_name' : model_names[rows['model_id']],
+        'num_params' : rows['num_params'],
+        'params'     : rows['params'][:, :max_params],
+        'covmat'     : rows['covmat'][:, :max_params, :max_params],
+        'window'     : window,
+        'bounds'     : bounds,
+        'models'     : json.dumps(models),
+        'fit_class'  : fits.fit_class.__name__
+    }
+
+
+def _json_default(obj):
+    # Convert numpy types (and anything else) in the metadata for JSON
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+
+    return str(obj)
+
+
+def _model_lookup(fit_models=None):
+    # Dictionary of model name -> FitModel object
+
+    if fit_models is None:
+        fit_models = []
+        for model_class in FitModel.__subclasses__():
+            try:
+                fit_models.append(model_class())
+            except TypeError:
+                # Models which need arguments must be given explicitly
+                pass
+
+    return {model.name: model for model in fit_models}
@@ -0,0 +1,240 @@
+'''
+    SPE_CATALOG.PY
+
+    A header-only index of directories of .SPE files.
+
+    The SPECatalog class scans a directory tree, reading only the 4100 byte
+    header of each .SPE file (see load_spe.SPEHeader), and stores the metadata
+    (date/time, exposure, number of frames, dimensions and wavelength
+    calibration) in a local SQLite database. Rescanning only reads the headers
+    of new or modified files (by modification time and size).
+
+    Queries return LazySpectrum objects: Spectrum objects whose metadata and
+    wavelength come from the catalog and whose data is only loaded from disk
+    (memory-mapped) when it is first accessed.
+'''
+
+
+import os
+import fnmatch
+import sqlite3
+import numpy as np
+
+from load_spe import *
+
+
+
+
+
+
+class LazySpectrum(Spectrum):
+
+    '''
+    Spectrum whose data is loaded from filename on first access.
+    '''
+
+    def __init__(
+        self,
+        filename = None,
+        wavelength = None,
+        xdim = None,
+        ydim = None,
+        num_frames = None,
+        exposure = None,
+        date_collected = None,
+        time_collected = None,
+        SPE_version = None
+    ):
+
+        self.filename = filename
+        self.date_collected = date_collected
+        self.time_collected = time_collected
+        self.SPE_version = SPE_version
+
+        self.wavelength = wavelength
+        self.xdim = xdim
+        self.ydim = ydim
+        self.num_frames = num_frames
+        self.exposure = exposure
+
+        self._data = None
+
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = load_SPE(self.filename, mmap=True).data
+
+        return self._data
+
+    @property
+    def int(self):
+        return self.data[0]
+
+
+
+
+
+
+class SPECatalog:
+
+    '''
+    SQLite index of the headers of .SPE files.
+    '''
+
+    columns = ['path', 'mtime', 'size', 'date_collected', 'time_collected',
+               'exposure', 'num_frames', 'xdim', 'ydim', 'datatype', 'startx',
+               'SPE_version', 'calib0', 'calib1', 'calib2', 'calib3', 'calib4', 'calib5']
+
+    def __init__(self, filename='spe_catalog.sqlite'):
+
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS spe_files (
+                path TEXT PRIMARY KEY,
+                mtime REAL,
+                size INTEGER,
+                date_collected TEXT,
+                time_collected TEXT,
+                exposure REAL,
+                num_frames INTEGER,
+                xdim INTEGER,
+                ydim INTEGER,
+                datatype INTEGER,
+                startx INTEGER,
+                SPE_version REAL,
+                calib0 REAL, calib1 REAL, calib2 REAL,
+                calib3 REAL, calib4 REAL, calib5 REAL
+            )
+        ''')
+        self.db.commit()
+
+
+    def close(self):
+        self.db.close()
+
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM spe_files').fetchone()[0]
+
+
+    def update(self, root, pattern='*.SPE'):
+        # Scans the directory tree at root for files matching pattern
+        # (case insensitive), reading the headers of new or modified files and
+        # removing files under root which no longer exist.
+        # Returns the number of (re)indexed and removed files.
+
+        root = os.path.abspath(root)
+
+        # Currently indexed files under root. The prefix is compared literally
+        # (LIKE would treat _ and % in the path as wildcards, and ignore case)
+        prefix = root + os.sep
+        indexed = {
+            path: (mtime, size) for path, mtime, size in self.db.execute(
+                'SELECT path, mtime, size FROM spe_files WHERE substr(path, 1, ?) = ?',
+                (len(prefix), prefix)
+            )
+        }
+
+        rows = []
+        found = set()
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in filenames:
+                if not fnmatch.fnmatch(name.lower(), pattern.lower()):
+                    continue
+
+                path = os.path.join(dirpath, name)
+                stat = os.stat(path)
+                found.add(path)
+
+                if indexed.get(path) == (stat.st_mtime, stat.st_size):
+                    continue
+
+                try:
+                    header = read_SPE_header(path)
+                except Exception as e:
+                    print('Error encountered reading header of ' + path + ':\n\t' + str(e))
+                    continue
+
+                rows.append(
+                    [path, stat.st_mtime, stat.st_size, header.date_collected,
+                     header.time_collected, header.exposure, header.num_frames,
+                     header.xdim, header.ydim, header.datatype,
+                     int(header.ROIinfoblk[0]['startx']), header.SPE_version]
+                    + [float(c) for c in header.calibration_poly]
+                )
+
+        removed = [(path,) for path in indexed if path not in found]
+
+        self.db.executemany(
+            'INSERT OR REPLACE INTO spe_files VALUES (' + ', '.join(['?'] * len(self.columns)) + ')',
+            rows
+        )
+        self.db.executemany('DELETE FROM spe_files WHERE path = ?', removed)
+        self.db.commit()
+
+        return len(rows), len(removed)
+
+
+    def query(self,
+              date_collected = None,
+              exposure = None,
+              xdim = None,
+              ydim = None,
+              num_frames = None,
+              where = None,
+              params = ()
+             ):
+        # Returns LazySpectrum objects for the indexed files matching all of
+        # the given values. where is an optional additional SQL condition on
+        # the columns (with ? placeholders filled from params).
+
+        conditions = []
+        values = []
+
+        for column, value in [('date_collected', date_collected), ('xdim', xdim),
+                              ('ydim', ydim), ('num_frames', num_frames)]:
+            if value is not None:
+                conditions.append(column + ' = ?')
+                values.append(value)
+
+        # Exposures are stored as single precision floats in the header
+        if exposure is not None:
+            conditions.append('ABS(exposure - ?) <= 1e-6 * ABS(?)')
+            values += [exposure, exposure]
+
+        if where is not None:
+            conditions.append('(' + where + ')')
+            values += list(params)
+
+        sql = 'SELECT * FROM spe_files'
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY path'
+
+        return [self.spectrum(row) for row in self.db.execute(sql, values)]
+
+
+    def spectrum(self, row):
+        # Creates a LazySpectrum from a row of the catalog
+
+        entry = dict(zip(self.columns, row))
+
+        # For SPE 2.X, the wavelength is determined from a quadratic taylor expansion
+        pixels = np.arange(entry['xdim']) + entry['startx']
+        wavelength = entry['calib0'] + entry['calib1'] * pixels + entry['calib2'] * pixels**2
+
+        return LazySpectrum(
+            filename = entry['path'],
+            wavelength = wavelength,
+            xdim = entry['xdim'],
+            ydim = entry['ydim'],
+            num_frames = entry['num_frames'],
+            exposure = entry['exposure'],
+            date_collected = entry['date_collected'],
+            time_collected = entry['time_collected'],
+            SPE_version = entry['SPE_version']
+        )
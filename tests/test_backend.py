@@ -0,0 +1,84 @@
+import os
+import sys
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pycftool_Backend import Backend, data_window, fit_frames, fit_window
+from pycftool_Fit import ResonanceFit1
+from pycftool_FitModel import Lorentzian_p1
+from Spectrum import Spectrum
+
+
+def drifting_spectrum(num_frames, drift, noise=0.02, seed=0):
+    model = Lorentzian_p1()
+    x = np.linspace(0, 10, 1000)
+    mus = 5 + np.linspace(0, drift, num_frames)
+    rng = np.random.default_rng(seed)
+    data = np.array([model.f(x, 5, mu, 0.3, 1, 0.01) for mu in mus])
+    data += noise * rng.standard_normal(data.shape)
+    return Spectrum(wavelength=x, data=data, xdim=len(x), ydim=1, num_frames=num_frames), mus
+
+
+def test_data_window_sorted_and_unsorted():
+    x = np.linspace(0, 1, 11)
+    window = data_window(x, (0.25, 0.65), x_sorted=True)
+    assert isinstance(window, slice)
+    np.testing.assert_array_equal(x[window], x[3:7])
+
+    shuffled = x[::-1]
+    np.testing.assert_array_equal(np.sort(shuffled[data_window(shuffled, (0.25, 0.65))]), x[3:7])
+
+
+def test_data_window_matches_mask():
+    rng = np.random.default_rng(0)
+    x = np.sort(rng.uniform(0, 10, 1000))
+
+    for limits in [(2, 5), (-1, 0.5), (9.5, 20), (5, 5), (x[10], x[20])]:
+        mask = (x > limits[0]) & (x < limits[1])
+        np.testing.assert_array_equal(x[data_window(x, limits, x_sorted=True)], x[mask])
+        np.testing.assert_array_equal(x[data_window(x, limits)], x[mask])
+
+
+def test_get_data_in_range_returns_views():
+    x = np.linspace(0, 10, 1001)
+    backend = Backend([Lorentzian_p1()], x, np.sin(x), ResonanceFit1)
+
+    window_x, window_y = backend.get_data_in_range((2, 3))
+    np.testing.assert_array_equal(window_x, x[(x > 2) & (x < 3)])
+    assert np.shares_memory(window_x, backend.x) and np.shares_memory(window_y, backend.y)
+
+
+def test_fit_window_robust_loss_ignores_outliers():
+    model = Lorentzian_p1()
+    x = np.linspace(-5, 5, 201)
+    y = model.f(x, 2, 0.5, 0.7, 1, 0.1)
+    y[::20] += 5
+
+    fit_params, _ = fit_window(model, x, y, [1.5, 0.3, 1, 0.5, 0], loss='soft_l1', outlier_threshold=3)
+    np.testing.assert_allclose(fit_params, [2, 0.5, 0.7, 1, 0.1], rtol=1e-4, atol=1e-6)
+
+
+def test_fit_frames_tracks_drift():
+    spectrum, mus = drifting_spectrum(200, drift=1.0)
+    params, covmats, converged = fit_frames(spectrum, Lorentzian_p1(), (3, 8), [4, 5, 0.5, 1, 0])
+
+    assert params.shape == (200, 5) and covmats.shape == (200, 5, 5)
+    assert np.all(converged)
+    np.testing.assert_allclose(params[:, 1], mus, atol=1e-3)
+    assert np.all(np.diagonal(covmats, axis1=1, axis2=2) > 0)
+
+
+def test_fit_frames_first_frame_failure_is_reported_per_frame():
+    spectrum, mus = drifting_spectrum(10, drift=0.1)
+    spectrum.data[0, 400:600] = np.nan
+
+    params, covmats, converged = fit_frames(spectrum, Lorentzian_p1(), (3, 8), [4, 5, 0.5, 1, 0])
+
+    assert not converged[0]
+    assert np.all(converged[1:])
+    np.testing.assert_allclose(params[1:, 1], mus[1:], atol=1e-3)
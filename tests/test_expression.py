@@ -0,0 +1,148 @@
+import glob
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pycftool_Expression import ExpressionModel
+from pycftool_FitModel import Lorentzian_p1
+
+
+EXPRESSIONS = [
+    'a*(g**2/4)/((x-mu)**2+g**2/4) + p0 + p1*(x-mu)',
+    'a*exp(-(x-mu)**2/(2*s**2)) + c*sqrt(abs(x)+b)',
+    'a*(q*g/2 + x - mu)**2/((x-mu)**2+g**2/4)',
+    'tanh(k*x)**n + arctan(b*x)/log(c) + x**k',
+    'a*exp(-(x-mu)**2/i) + params*out',
+    '-a*sin(w*x + phi)*cos(x/w) + tan(x/t) - sinh(x/u)/cosh(x/u) + e*pi*sign(x)*x/v',
+]
+
+
+def numeric_jac(model, x, params, h=1e-6):
+    # Central finite differences of model.f with respect to the parameters
+    J = np.empty((len(x), len(params)))
+    for k in range(len(params)):
+        step = h * max(1, abs(params[k]))
+        up = np.array(params, dtype=float)
+        down = np.array(params, dtype=float)
+        up[k] += step
+        down[k] -= step
+        J[:, k] = (model.f(x, *up) - model.f(x, *down)) / (2 * step)
+    return J
+
+
+@pytest.mark.parametrize('expression', EXPRESSIONS)
+def test_jacobian_matches_finite_differences(expression, tmp_path):
+    model = ExpressionModel(expression, cache_dir=str(tmp_path))
+
+    rng = np.random.default_rng(0)
+    x = np.linspace(0.5, 2, 25)
+
+    for trial in range(3):
+        params = rng.uniform(1.2, 2, model.num_params)
+        J = model.jac(x, *params)
+
+        assert J.shape == (len(x), model.num_params)
+        np.testing.assert_allclose(J, numeric_jac(model, x, params), rtol=1e-5, atol=1e-6)
+
+
+def test_matches_builtin_lorentzian(tmp_path):
+    model = ExpressionModel('a/(1 + ((x-mu)/(gamma/2))**2) + p0 + p1*(x-mu)',
+                            cache_dir=str(tmp_path))
+    reference = Lorentzian_p1()
+
+    assert model.param_names == reference.param_names
+
+    x = np.linspace(-5, 5, 101)
+    params = [2, 0.3, 0.7, 1, 0.2]
+    np.testing.assert_allclose(model.f(x, *params), reference.f(x, *params))
+    np.testing.assert_allclose(model.jac(x, *params), reference.jac(x, *params), atol=1e-12)
+
+
+def test_cached_model_matches_generated(tmp_path):
+    expression = EXPRESSIONS[1]
+    first = ExpressionModel(expression, cache_dir=str(tmp_path))
+    second = ExpressionModel(expression, cache_dir=str(tmp_path))
+
+    x = np.linspace(0.5, 2, 25)
+    params = np.linspace(1.2, 2, first.num_params)
+    np.testing.assert_allclose(first.jac(x, *params), second.jac(x, *params))
+
+
+def test_tampered_cache_is_not_executed(tmp_path):
+    expression = EXPRESSIONS[0]
+    ExpressionModel(expression, cache_dir=str(tmp_path))
+
+    marker = tmp_path / 'executed'
+    cache_file, = glob.glob(str(tmp_path / 'expr_*.json'))
+
+    with open(cache_file) as f:
+        cached = json.load(f)
+    cached['derivatives'][0] = "__import__('os').mkdir(%r)" % str(marker)
+    with open(cache_file, 'w') as f:
+        json.dump(cached, f)
+
+    model = ExpressionModel(expression, cache_dir=str(tmp_path))
+    x = np.linspace(-5, 5, 11)
+    model.jac(x, 2, 0.3, 0.7, 1, 0.2)
+
+    assert not marker.exists()
+    np.testing.assert_allclose(model.jac(x, 2, 0.3, 0.7, 1, 0.2),
+                               numeric_jac(model, x, [2, 0.3, 0.7, 1, 0.2]), rtol=1e-5, atol=1e-6)
+
+
+def test_unsupported_syntax():
+    with pytest.raises(ValueError):
+        ExpressionModel("a*foo(x)")
+    with pytest.raises(ValueError):
+        ExpressionModel("a*x.__class__")
+
+
+def test_unbounded_model_fits(tmp_path):
+    from pycftool_Backend import fit_window
+
+    model = ExpressionModel('a/(1 + ((x-mu)/(g/2))**2) + p0', cache_dir=str(tmp_path))
+    x = np.linspace(-5, 5, 201)
+    y = model.f(x, 2, 0.5, 0.7, 1)
+
+    fit_params, fit_covmat = fit_window(model, x, y, [1.5, 0.3, 1, 0.5])
+    np.testing.assert_allclose(fit_params, [2, 0.5, 0.7, 1], rtol=1e-6)
+
+
+@pytest.mark.parametrize('expression', EXPRESSIONS)
+def test_kernels_match_numpy(expression, tmp_path):
+    # The loop kernels are run as plain Python (compiled with numba if installed)
+    from pycftool_Expression import _NAMESPACE, _generate
+
+    model = ExpressionModel(expression, cache_dir=str(tmp_path))
+    namespace = dict(_NAMESPACE)
+    exec(_generate(expression, str(tmp_path))['source'], namespace)
+
+    x = np.linspace(0.5, 2, 25)
+    params = np.linspace(1.2, 2, model.num_params)
+    out = np.empty(len(x))
+    jac_out = np.empty((len(x), model.num_params))
+
+    namespace['f_jac_kernel'](x, params, out, jac_out)
+    np.testing.assert_allclose(out, model.f(x, *params))
+    np.testing.assert_allclose(jac_out, model.jac(x, *params))
+
+    namespace['f_kernel'](x, params, out)
+    np.testing.assert_allclose(out, model.f(x, *params))
+
+    jac_out[...] = 0
+    namespace['jac_kernel'](x, params, jac_out)
+    np.testing.assert_allclose(jac_out, model.jac(x, *params))
+
+
+def test_kernels_not_shared_by_name(tmp_path):
+    # A model named like a built-in one does not get its compiled kernels
+    model = ExpressionModel('a*x**2 + b', name='Lorentzian_poly1', cache_dir=str(tmp_path))
+
+    x = np.linspace(-1, 1, 11)
+    np.testing.assert_allclose(model.evaluate(x, 2, 1), 2*x**2 + 1)
+    np.testing.assert_allclose(model.evaluate_jac(x, 2, 1), np.stack([x**2, np.ones_like(x)], axis=-1))
@@ -0,0 +1,103 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pycftool_Fit import FIT_FAILED, FIT_OK, Fit, FitCollection, ResonanceFit1
+from pycftool_FitModel import Lorentzian_multi, Lorentzian_p1, Lorentzian_p2
+
+
+x = np.linspace(0, 10, 101)
+y = np.sin(x)
+
+p1 = Lorentzian_p1()
+p2 = Lorentzian_p2()
+multi = Lorentzian_multi(2)
+
+
+def make_fit(model, start, params, fit_class=Fit, window=None):
+    n = model.num_params
+    params = np.asarray(params, dtype=float)
+    covmat = np.diag(np.arange(1, n + 1) * 1e-4) + 1e-6
+    return fit_class(x, y, slice(start, start + 10) if window is None else window,
+                     model, params, covmat)
+
+
+def mixed_fits():
+    return [
+        make_fit(p1, 0, [1, 2, 0.1, 0, 0]),
+        make_fit(p2, 20, [2, 3, 0.2, 0, 0, 0.5]),
+        make_fit(multi, 40, [1, 5, 0.1, 2, 5.5, 0.2, 0, 0]),
+        make_fit(p1, 70, [3, 8, 0.4, 1, 0]),
+    ]
+
+
+def assert_same_fits(fits, expected):
+    assert len(fits) == len(expected)
+    for fit, ref in zip(fits, expected):
+        assert fit.fit_model.name == ref.fit_model.name
+        np.testing.assert_array_equal(fit.fit_params, ref.fit_params)
+        np.testing.assert_array_equal(fit.fit_covmat, ref.fit_covmat)
+        np.testing.assert_array_equal(fit.x, ref.x)
+
+
+def test_collection_mixed_widths_and_growth():
+    fits = mixed_fits()
+    collection = FitCollection(x, y, capacity=1)
+    collection.extend(fits)
+
+    assert len(collection) == 4
+    assert collection.params.shape == (4, multi.num_params)
+    assert_same_fits(list(collection), fits)
+
+    # Rows written before the widening keep NaN padding
+    assert np.all(np.isnan(collection.params[0, 5:]))
+    assert np.all(np.isnan(collection.covmat[0, 5:, :]))
+
+    np.testing.assert_array_equal(collection.param('gamma'), [0.1, 0.2, np.nan, 0.4])
+    np.testing.assert_array_equal(collection.param('mu1'), [np.nan, np.nan, 5.5, np.nan])
+    np.testing.assert_allclose(collection.param('a', column='stderr')[[0, 1, 3]], np.sqrt(1e-4 + 1e-6))
+
+
+def test_collection_delete():
+    fits = mixed_fits()
+    collection = FitCollection(x, y)
+    collection.extend(fits)
+
+    deleted = collection.delete(-1)
+    assert_same_fits([deleted], [fits[3]])
+    assert_same_fits(list(collection), fits[:3])
+
+    collection.delete(0)
+    assert_same_fits(list(collection), fits[1:3])
+
+    assert_same_fits([collection.pop()], [fits[2]])
+    assert len(collection) == 1
+
+    for index in [1, -2]:
+        with pytest.raises(IndexError):
+            collection.delete(index)
+
+
+def test_collection_where_and_sort_by():
+    collection = FitCollection(x, y, fit_class=ResonanceFit1)
+    for start, mu, gamma in [(0, 2, 0.1), (20, 3, 0.6), (40, 5, 0.1), (60, 7, 0.35)]:
+        collection.append(make_fit(p1, start, [1, mu, gamma, 0, 0], ResonanceFit1))
+    collection.append(make_fit(p1, 80, [1, 9, 0.1, 0, 0], ResonanceFit1), status=FIT_FAILED)
+
+    good = collection.where(collection.status == FIT_OK)
+    assert len(good) == 4 and len(collection) == 5
+
+    high_Q = good.where(good.Q > 10)
+    np.testing.assert_array_equal(high_Q.param('mu'), [2, 5, 7])
+    assert all(isinstance(fit, ResonanceFit1) for fit in high_Q)
+
+    np.testing.assert_array_equal(good.sort_by('Q').Q, np.sort(good.Q))
+    np.testing.assert_array_equal(good.sort_by('gamma', reverse=True).param('gamma'), [0.6, 0.35, 0.1, 0.1])
+
+    subset = collection[1:3]
+    assert isinstance(subset, FitCollection) and len(subset) == 2
+    assert subset[0].Q == collection[1].Q
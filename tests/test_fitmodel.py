@@ -0,0 +1,66 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from scipy.optimize import curve_fit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pycftool_FitModel
+from pycftool_Backend import fit_window
+from pycftool_FitModel import Lorentzian_p1, Lorentzian_p2
+
+
+class CountingLorentzian(Lorentzian_p1):
+    # Counts the model evaluations (subclasses do not inherit the kernels, so
+    # this always runs the NumPy f and jac)
+    calls = 0
+
+    def f(self, x, *params):
+        CountingLorentzian.calls += 1
+        return super().f(x, *params)
+
+
+@pytest.mark.parametrize('model, kernels', [
+    (Lorentzian_p1(), ('_lorentzian_p1_f', '_lorentzian_p1_f_jac', '_lorentzian_p1_jac')),
+    (Lorentzian_p2(), ('_lorentzian_p2_f', '_lorentzian_p2_f_jac', '_lorentzian_p2_jac')),
+])
+def test_builtin_kernels_match_numpy(model, kernels):
+    # The kernels are run as plain Python (they are only compiled with numba)
+    f_kernel, f_jac_kernel, jac_kernel = [getattr(pycftool_FitModel, k) for k in kernels]
+
+    x = np.linspace(-3, 4, 51)
+    params = np.array([2, 0.3, 0.7, 1, 0.2, 0.05][:model.num_params])
+    out = np.empty(len(x))
+    jac_out = np.empty((len(x), model.num_params))
+
+    f_kernel(x, params, out)
+    np.testing.assert_allclose(out, model.f(x, *params))
+
+    jac_kernel(x, params, jac_out)
+    np.testing.assert_allclose(jac_out, model.jac(x, *params), atol=1e-15)
+
+    out[...] = jac_out[...] = 0
+    f_jac_kernel(x, params, out, jac_out)
+    np.testing.assert_allclose(out, model.f(x, *params))
+    np.testing.assert_allclose(jac_out, model.jac(x, *params), atol=1e-15)
+
+
+def test_evaluate_jac_does_not_evaluate_model():
+    model = CountingLorentzian()
+    x = np.linspace(-5, 5, 201)
+    y = Lorentzian_p1().f(x, 2, 0.5, 0.7, 1, 0.1)
+    p0 = [1.5, 0.3, 1, 0.5, 0]
+
+    CountingLorentzian.calls = 0
+    model.evaluate_jac(x, *p0)
+    assert CountingLorentzian.calls == 0
+
+    curve_fit(model.f, x, y, p0=p0, jac=model.jac, bounds=(model.param_min, model.param_max))
+    direct = CountingLorentzian.calls
+
+    CountingLorentzian.calls = 0
+    fit_params, fit_covmat = fit_window(model, x, y, p0)
+    assert CountingLorentzian.calls == direct
+    np.testing.assert_allclose(fit_params, [2, 0.5, 0.7, 1, 0.1], rtol=1e-6)
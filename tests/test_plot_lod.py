@@ -0,0 +1,71 @@
+import os
+import sys
+
+import matplotlib
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from plot_lod import LODLine, MinMaxPyramid
+
+
+def test_levels_hold_bin_extrema():
+    rng = np.random.default_rng(0)
+    y = rng.standard_normal(1001)
+    pyramid = MinMaxPyramid(np.arange(len(y)), y, min_points=8)
+
+    for k, (imin, imax) in enumerate(pyramid.levels, start=1):
+        size = 2**k
+        for b in [0, 1, len(imin) // 2, len(imin) - 1]:
+            bin_y = y[b * size:(b + 1) * size]
+            assert y[imin[b]] == bin_y.min()
+            assert y[imax[b]] == bin_y.max()
+
+
+def test_view_keeps_extrema_and_point_budget():
+    rng = np.random.default_rng(1)
+    x = np.linspace(0, 100, 200001)
+    y = 0.1 * rng.standard_normal(len(x))
+    y[123457] = 10      # Narrow peak
+    y[54321] = -10      # Narrow dip
+
+    pyramid = MinMaxPyramid(x, y)
+
+    view_x, view_y = pyramid.view((0, 100), 500)
+    assert len(view_x) <= 2 * 500 + 4
+    assert np.all(np.diff(view_x) >= 0)
+    assert view_y.max() == 10 and view_y.min() == -10
+
+    # Zoomed in far enough, the raw data is returned (with one point beyond each end)
+    view_x, view_y = pyramid.view((50, 50.01), 500)
+    inside = (x >= 50) & (x <= 50.01)
+    np.testing.assert_array_equal(view_x[1:-1], x[inside])
+
+
+def test_unsorted_data_is_sorted():
+    x = np.array([3.0, 1.0, 2.0, 0.0])
+    pyramid = MinMaxPyramid(x, x * 10, min_points=1)
+    np.testing.assert_array_equal(pyramid.x, [0, 1, 2, 3])
+    np.testing.assert_array_equal(pyramid.y, [0, 10, 20, 30])
+
+
+def test_lod_line_follows_xlim():
+    x = np.linspace(0, 100, 100001)
+    y = np.sin(x)
+
+    fig, ax = plt.subplots(figsize=(4, 3), dpi=100)
+    line, = ax.plot(x, y)
+    lod = LODLine(line, x, y)
+
+    assert len(line.get_xdata()) < len(x)
+
+    ax.set_xlim(10, 10.05)
+    np.testing.assert_array_equal(line.get_xdata()[1:-1], x[(x >= 10) & (x <= 10.05)])
+
+    lod.disconnect()
+    ax.set_xlim(0, 100)
+    assert len(line.get_xdata()) < 100
+    plt.close(fig)
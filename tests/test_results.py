@@ -0,0 +1,97 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pycftool_Fit import Fit, FitCollection
+from pycftool_FitModel import Lorentzian_multi, Lorentzian_p1, Lorentzian_p2
+from pycftool_Results import ResultsStore
+
+
+x = np.linspace(0, 10, 101)
+y = np.sin(x)
+
+p1 = Lorentzian_p1()
+p2 = Lorentzian_p2()
+multi = Lorentzian_multi(2)
+
+
+def make_fit(model, start, params, fit_class=Fit, window=None):
+    n = model.num_params
+    params = np.asarray(params, dtype=float)
+    covmat = np.diag(np.arange(1, n + 1) * 1e-4) + 1e-6
+    return fit_class(x, y, slice(start, start + 10) if window is None else window,
+                     model, params, covmat)
+
+
+def mixed_fits():
+    return [
+        make_fit(p1, 0, [1, 2, 0.1, 0, 0]),
+        make_fit(p2, 20, [2, 3, 0.2, 0, 0, 0.5]),
+        make_fit(multi, 40, [1, 5, 0.1, 2, 5.5, 0.2, 0, 0]),
+        make_fit(p1, 70, [3, 8, 0.4, 1, 0]),
+    ]
+
+
+def assert_same_fits(fits, expected):
+    assert len(fits) == len(expected)
+    for fit, ref in zip(fits, expected):
+        assert fit.fit_model.name == ref.fit_model.name
+        np.testing.assert_array_equal(fit.fit_params, ref.fit_params)
+        np.testing.assert_array_equal(fit.fit_covmat, ref.fit_covmat)
+        np.testing.assert_array_equal(fit.x, ref.x)
+
+
+def test_store_round_trip(tmp_path):
+    store = ResultsStore(str(tmp_path / 'results.npz'))
+    fits = mixed_fits()
+
+    store.write(x, y, {'exposure': np.float32(0.5), 'name': 'test'}, fits[:2])
+
+    collection = FitCollection(x, y, fit_class=Fit)
+    collection.extend(fits[2:])
+    store.append(collection)
+    store.append([])
+
+    assert store.chunks() == ['fits_00000', 'fits_00001']
+
+    data_x, data_y, meta = store.load_data()
+    np.testing.assert_array_equal(data_x, x)
+    np.testing.assert_array_equal(data_y, y)
+    assert meta == {'exposure': 0.5, 'name': 'test'}
+
+    loaded = store.load_fits(fit_models=[p1, p2, multi])
+    assert_same_fits(loaded, fits)
+    assert [fit.window for fit in loaded] == [fit.window for fit in fits]
+
+    # Columns are padded to the widest model across chunks
+    params = store.column('params')
+    assert params.shape == (4, multi.num_params)
+    np.testing.assert_array_equal(params[1, :6], fits[1].fit_params)
+    assert np.all(np.isnan(params[0, 5:]))
+    assert list(store.column('model_name')) == [fit.fit_model.name for fit in fits]
+
+    np.testing.assert_array_equal(store.param('mu'), [2, 3, np.nan, 8])
+    np.testing.assert_array_equal(store.param('p2'), [np.nan, 0.5, np.nan, np.nan])
+
+
+def test_store_unsorted_and_empty_windows(tmp_path):
+    store = ResultsStore(str(tmp_path / 'results.npz'))
+    window = np.flatnonzero((x > 2) & (x < 3))
+
+    fits = [make_fit(p1, 0, [1, 2.5, 0.1, 0, 0], window=window),
+            make_fit(p1, 0, [1, 5, 0.1, 0, 0], window=slice(50, 50))]
+
+    collection = FitCollection(x, y)
+    collection.extend(fits)
+    store.write(x, y, {}, collection)
+
+    bounds = store.column('bounds')
+    np.testing.assert_array_equal(bounds[0], [x[window[0]], x[window[-1]]])
+    assert np.all(np.isnan(bounds[1]))
+
+    loaded = store.load_fits()
+    np.testing.assert_array_equal(loaded[0].x, x[window])
+    assert len(loaded[1].x) == 0
@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from load_spe import SPE_HEADER_DTYPE, load_SPE, read_SPE_header
+from spe_catalog import SPECatalog
+
+
+def write_spe(filename, data, exposure=1.0, calibration=(500, 0.1, 0)):
+    # Writes a minimal SPE v2.x file with float32 frames data (num_frames, xdim)
+    header = np.zeros(1, dtype=SPE_HEADER_DTYPE)
+    header['xdim'] = data.shape[1]
+    header['ydim'] = 1
+    header['NumFrames'] = data.shape[0]
+    header['datatype'] = 0
+    header['exp_sec'] = exposure
+    header['date'] = b'01Jan2020'
+    header['file_header_ver'] = 2.5
+    header['xcalibration']['polynom_coeff'][0, :3] = calibration
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(np.asarray(data, dtype=np.float32).tobytes())
+
+
+def test_header_and_data_round_trip(tmp_path):
+    filename = str(tmp_path / 'a.SPE')
+    data = np.arange(12, dtype=np.float32).reshape(3, 4)
+    write_spe(filename, data, exposure=0.5)
+
+    header = read_SPE_header(filename)
+    assert (header.xdim, header.ydim, header.num_frames) == (4, 1, 3)
+    assert header.exposure == 0.5
+
+    for mmap in [False, True]:
+        spectrum = load_SPE(filename, mmap=mmap)
+        np.testing.assert_array_equal(spectrum.data, data)
+        np.testing.assert_allclose(spectrum.wavelength, 500 + 0.1 * np.arange(4))
+
+
+def test_update_and_query(tmp_path):
+    root = tmp_path / 'data'
+    write_spe(str(root / 'a.SPE'), np.ones((1, 8)), exposure=1)
+    write_spe(str(root / 'sub' / 'b.spe'), np.ones((2, 8)), exposure=2)
+
+    catalog = SPECatalog(str(tmp_path / 'catalog.sqlite'))
+    assert catalog.update(str(root)) == (2, 0)
+    assert catalog.update(str(root)) == (0, 0)
+
+    spectra = catalog.query(exposure=2)
+    assert [os.path.basename(s.filename) for s in spectra] == ['b.spe']
+    np.testing.assert_array_equal(spectra[0].data, np.ones((2, 8)))
+
+    # Modified and removed files
+    time.sleep(0.01)
+    write_spe(str(root / 'a.SPE'), np.ones((3, 8)), exposure=1)
+    os.remove(str(root / 'sub' / 'b.spe'))
+    assert catalog.update(str(root)) == (1, 1)
+    assert [s.num_frames for s in catalog.query()] == [3]
+
+    catalog.close()
+
+
+def test_update_does_not_touch_sibling_directories(tmp_path):
+    # _ and % in the root must not act as wildcards when selecting the files
+    # indexed under it, nor must the match be case insensitive
+    write_spe(str(tmp_path / 'runX1' / 'b.SPE'), np.ones((1, 8)))
+    write_spe(str(tmp_path / 'RUN_1' / 'c.SPE'), np.ones((1, 8)))
+    os.makedirs(str(tmp_path / 'run_1'), exist_ok=True)
+
+    catalog = SPECatalog(str(tmp_path / 'catalog.sqlite'))
+    assert catalog.update(str(tmp_path / 'runX1')) == (1, 0)
+    assert catalog.update(str(tmp_path / 'RUN_1')) == (1, 0)
+    assert catalog.update(str(tmp_path / 'run_1')) == (0, 0)
+    assert len(catalog) == 2
+
+    catalog.close()
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from Spectrum import Spectrum
+
+
+def test_frames_are_views_of_data():
+    frames = [np.arange(5.0) + i for i in range(3)]
+    spectrum = Spectrum(wavelength=np.arange(5.0), data=frames, xdim=5, ydim=1, num_frames=3)
+
+    assert spectrum.data.shape == (3, 5)
+    assert np.shares_memory(spectrum.int, spectrum.data)
+    assert not np.shares_memory(spectrum.int, frames[0])
+    assert np.shares_memory(spectrum.to_image(), spectrum.data)
+
+
+def test_frame_reductions():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 100, (10, 7)).astype(np.uint16)
+    spectrum = Spectrum(data=data, xdim=7, ydim=1, num_frames=10)
+    background = np.full(7, 3.0)
+
+    for chunk in [1, 3, 64]:
+        np.testing.assert_allclose(spectrum.mean_frame(chunk), data.mean(axis=0))
+        np.testing.assert_array_equal(spectrum.max_frame(chunk), data.max(axis=0))
+        np.testing.assert_allclose(spectrum.sum_frames(background, chunk),
+                                   data.sum(axis=0, dtype=float) - 10 * background)